@@ -0,0 +1,194 @@
+'''
+Benchmark and accuracy-regression suite for the ch09 field pipeline
+(integrate_n, BVec, CurrentLoop.compute_B, Solenoid.compute_B).
+
+    python bench_ch09.py                          # run, print, write bench_results.json
+    python bench_ch09.py --save-baseline          # run and store as the baseline
+    python bench_ch09.py --baseline bench_baseline.json --threshold 0.25
+
+Every case records wall time (best of --repeat), integrand evaluations per second
+(as counted by fieldprof.Profile: three integrate_n passes for 'scalar', the extended
+grid of one loop for method 'shift') and peak traced memory. The timed runs are
+not traced: memory and evaluations come from one more, untimed, run. With a baseline, a case whose time grows by more than
+threshold (relative) is a regression. Any failed accuracy check is a regression too.
+The exit status is 1 if there is any regression.
+'''
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from math import pi, sin, sqrt
+
+import numpy as np
+
+from P09111 import integrate_n, BACKENDS, Bcloop, CurrentLoop, Solenoid
+from fieldprof import Profile
+
+
+mu0 = 4e-7 * pi
+
+# name: (source, grid points per axis, N, turns, backend, method)
+CASES = {
+    'loop-fused-9-N100':      ('loop', 9, 100, 1, 'fused', 'loops'),
+    'loop-numpy-27-N100':     ('loop', 27, 100, 1, 'numpy', 'loops'),
+    'loop-numpy-27-N1000':    ('loop', 27, 1000, 1, 'numpy', 'loops'),
+    'loop-elliptic-60':       ('loop', 60, 0, 1, 'elliptic', 'loops'),
+    'loop-adaptive-27':       ('loop', 27, 65536, 1, 'adaptive', 'loops'),
+    'sol10-numpy-21-N100':    ('solenoid', 21, 100, 10, 'numpy', 'loops'),
+    'sol40-numpy-21-N100':    ('solenoid', 21, 100, 40, 'numpy', 'loops'),
+    'sol40-shift-21-N100':    ('solenoid', 21, 100, 40, 'numpy', 'shift'),
+    'sol400-shift-21-N100':   ('solenoid', 21, 100, 400, 'numpy', 'shift'),
+}
+
+QUICK = ['loop-fused-9-N100', 'loop-numpy-27-N100', 'loop-elliptic-60',
+         'sol10-numpy-21-N100', 'sol40-shift-21-N100']
+
+
+def run_case(source, n, N, turns, backend, method, repeat=3):
+    '''
+    Time one compute_B call. Return a dict of measurements.
+    '''
+    R = 0.004
+    L = 0.01
+    Xs = np.linspace(-2*R, 2*R, n)
+    if source == 'loop':
+        src = CurrentLoop(0, R, 1.8, mu0)
+        Zs = np.linspace(-2*R, 2*R, n)
+        kwargs = {}
+    else:
+        src = Solenoid(R, 1.8, mu0, turns, L)
+        Zs = np.linspace(-R, L + R, n)
+        kwargs = {'method': method}
+
+    best = None
+    for r in range(repeat):
+        t = time.perf_counter()
+        src.compute_B(Xs, Xs, Zs, N, backend, **kwargs)
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    # end for r
+
+    # Peak memory and the evaluations actually made, from one more run:
+    # tracemalloc slows the pure-Python backends many times over, so it is not timed.
+    profile = Profile()
+    tracemalloc.start()
+    src.compute_B(Xs, Xs, Zs, N, backend, profile=profile, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    points = n**3
+    evals = profile.counts.get('evals', 0)
+
+    return {'points': points, 'N': N, 'turns': turns, 'backend': backend,
+            'method': method, 'time_s': best, 'evals': evals,
+            'evals_per_s': evals/best, 'peak_MB': peak/2**20}
+
+
+def accuracy_checks():
+    '''
+    Compare against known references. Return a list of dicts (name, error, tol, ok).
+    '''
+    checks = []
+
+    def check(name, value, exact, tol):
+        err = abs(value - exact)/abs(exact)
+        checks.append({'name': name, 'rel_error': err, 'tol': tol, 'ok': bool(err <= tol)})
+
+    # Known integrals (P09109 tests)
+    check('integrate_n x^3 [0,1] n=1000', integrate_n(lambda x: x**3, 0, 1, 1000), 0.25, 1e-6)
+    check('integrate_n sin [0,pi] n=100', integrate_n(sin, 0, pi, 100), 2.0, 1e-4)
+    check('integrate_n batched sin [0,pi] n=100',
+          integrate_n(np.sin, 0, pi, 100, batched=True), 2.0, 1e-4)
+
+    # On-axis field of a loop (Bcloop, from the notebook)
+    R, I = 0.02, 0.3
+    for z in [-0.2, -0.01, 0.0, 0.03]:
+        exact = Bcloop(z, R, I, mu0)
+        for name in BACKENDS:
+            Bz = BACKENDS[name]((0, 0, z), R, I, mu0, 1000)[2]
+            check('BVec {} on axis z={}'.format(name, z), Bz, exact, 1e-9)
+        for name in ['numpy', 'elliptic', 'adaptive']:
+            Bz = CurrentLoop(0, R, I, mu0).compute_B([0], [0], [z], 1000, name)[2][0, 0, 0]
+            check('compute_B {} on axis z={}'.format(name, z), Bz, exact, 1e-9)
+    # end for z
+
+    # Long solenoid: B = mu0 n I at the center (with the finite-length factor).
+    # turns loops over L are turns - 1 pitches: n = (turns - 1)/L. The rest is the
+    # discreteness of the winding, about 2e-7 here.
+    R, I, turns, L = 0.002, 1.0, 2001, 0.2
+    s = Solenoid(R, I, mu0, turns, L)
+    exact = mu0 * (turns - 1)/L * I * (L/2)/sqrt(R**2 + (L/2)**2)
+    for backend, method in [('elliptic', 'shift'), ('numpy', 'loops')]:
+        Bz = s.compute_B([0], [0], [L/2], N=100, backend=backend, method=method)[2][0, 0, 0]
+        check('long solenoid {} {} vs mu0 n I'.format(backend, method), Bz, exact, 1e-6)
+
+    return checks
+
+
+def compare(results, baseline, threshold):
+    '''
+    Return a list of regression messages.
+    '''
+    msgs = []
+    for name, r in results['cases'].items():
+        b = baseline.get('cases', {}).get(name)
+        if b is None:
+            continue
+        if r['time_s'] > b['time_s']*(1 + threshold):
+            msgs.append('{}: {:.4f} s vs baseline {:.4f} s'.format(name, r['time_s'], b['time_s']))
+    # end for name
+    for c in results['accuracy']:
+        if not c['ok']:
+            msgs.append('accuracy: {}: rel. error {:.2e} > {:.0e}'.format(c['name'], c['rel_error'], c['tol']))
+
+    return msgs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ch09 field pipeline.')
+    parser.add_argument('--cases', nargs='*', default=None, help='case names (default: all)')
+    parser.add_argument('--quick', action='store_true', help='run a small subset')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--baseline', default='bench_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative slowdown before a case counts as a regression')
+    args = parser.parse_args()
+
+    names = args.cases or (QUICK if args.quick else list(CASES))
+    results = {'cases': {}, 'accuracy': []}
+
+    for name in names:
+        r = run_case(*CASES[name], repeat=args.repeat)
+        results['cases'][name] = r
+        print('{:24s} {:10.4f} s {:12.3e} evals/s {:8.1f} MB'.format(
+              name, r['time_s'], r['evals_per_s'], r['peak_MB']))
+    # end for name
+
+    results['accuracy'] = accuracy_checks()
+    for c in results['accuracy']:
+        print('{:4s} {:44s} rel. error {:.2e} (tol {:.0e})'.format(
+              'ok' if c['ok'] else 'FAIL', c['name'], c['rel_error'], c['tol']))
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Baseline saved to', args.baseline)
+        sys.exit(0)
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+        print('No baseline at {}; timings are not compared.'.format(args.baseline))
+
+    msgs = compare(results, baseline, args.threshold)
+    for m in msgs:
+        print('REGRESSION', m)
+    sys.exit(1 if msgs else 0)
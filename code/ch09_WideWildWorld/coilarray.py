@@ -0,0 +1,251 @@
+from time import perf_counter
+
+import numpy as np
+
+from P09111 import B_elliptic, grid_out, compute_B_parallel
+
+
+def loop_frames(normals):
+    '''
+    Rotations taking global coordinates to each loop's own frame.
+    normals: (M, 3) unit normals.
+    Return (M, 3, 3) matrices with rows e1, e2, n (so local = rot @ global).
+    A loop with normal +z gets the identity.
+    '''
+    n = normals
+    # Any direction not parallel to n, to build e1, e2 from.
+    a = np.zeros_like(n)
+    use_x = np.abs(n[:, 0]) < 0.9
+    a[use_x, 0] = 1
+    a[~use_x, 1] = 1
+
+    e2 = np.cross(n, a)
+    e2 /= np.linalg.norm(e2, axis=1)[:, None]
+    e1 = np.cross(e2, n)
+
+    return np.ascontiguousarray(np.stack([e1, e2, n], axis=1))
+
+
+class CoilArray:
+    '''
+    Any number of circular loops, each with its own center, normal, radius and current.
+    The current of a loop flows counter-clockwise looking from the tip of its normal
+    (the CurrentLoop convention, with normal +z).
+
+    All loops are kept in contiguous arrays, and compute_B evaluates the closed-form
+    field (B_elliptic) of a block of loops on a block of points at once (see B_at):
+    each point is rotated into every loop's frame (broadcast multiply-adds of
+    (loops, 1) rotation entries with (loops, points) offsets), evaluated,
+    rotated back the same way and summed over the loops.
+    Blocks of loops along +z skip the rotations.
+    There is no Python loop over single loops or points.
+    '''
+
+    def __init__(self, centers, normals, radii, currents, mu0):
+        '''
+        centers: (M, 3) loop centers.
+        normals: (M, 3) loop normals (need not be unit vectors).
+        radii: (M,) loop radii, or one radius for all.
+        currents: (M,) loop currents, or one current for all.
+        mu0: permeability of free space
+        '''
+        self.centers = np.ascontiguousarray(np.reshape(centers, (-1, 3)), dtype=float)
+        M = len(self.centers)
+
+        normals = np.array(np.broadcast_to(np.reshape(normals, (-1, 3)), (M, 3)), dtype=float)
+        self.normals = normals / np.linalg.norm(normals, axis=1)[:, None]
+        self.R = np.ascontiguousarray(np.broadcast_to(np.asarray(radii, dtype=float), (M,)))
+        self.I = np.ascontiguousarray(np.broadcast_to(np.asarray(currents, dtype=float), (M,)))
+        self.mu0 = mu0
+        self.rot = loop_frames(self.normals)
+        self.aligned = np.all(self.rot == np.eye(3), axis=(1, 2))   # normal +z: no rotation
+
+    def __len__(self):
+        return len(self.centers)
+
+    def compute_B(self, X, Y, Z, mem_limit=256*2**20, workers=1, cache=None,
+                  add_to=None, profile=None):
+        '''
+        X, Y, Z: field ranges along x, y, z-axes
+        mem_limit: a bound (in bytes) on the working (loop, point) arrays.
+        workers, cache, add_to, profile: see CurrentLoop.compute_B
+
+        The (loop, point) pairs are evaluated in blocks of loops x blocks of points,
+        each block small enough that its work arrays stay under mem_limit.
+        On the wire of any loop, B is nan.
+        Return Bx, By, Bz in shape (len(X), len(Y), len(Z)).
+        '''
+
+        if cache is not None or workers > 1:
+            if cache is not None:
+                B = cache.compute_B(self, X, Y, Z, mem_limit=mem_limit,
+                                    workers=workers, profile=profile)
+            else:
+                t = perf_counter()
+                B = compute_B_parallel(self, X, Y, Z, workers, mem_limit=mem_limit)
+                if profile is not None:
+                    profile.add_time('workers', perf_counter() - t)
+            if add_to is None:
+                return B
+            for A, Bc in zip(add_to, B):
+                A += Bc
+            return add_to
+
+        if profile is not None:
+            t = perf_counter()
+            profile.start(len(self)*len(X)*len(Y)*len(Z))
+
+        X = np.asarray(X, dtype=float)
+        Y = np.asarray(Y, dtype=float)
+        Z = np.asarray(Z, dtype=float)
+        shape = (len(X), len(Y), len(Z))
+        (Bx, By, Bz), (bx, by, bz) = grid_out(shape, add_to)
+
+        M = len(self)
+        # Roughly 32 float64 temporaries per (loop, point) pair:
+        # local coordinates, B_elliptic's work arrays, the rotated field.
+        # Blocks of at most 2^14 pairs (4 MB) keep the work arrays in cache.
+        # The points fill a block first (a few loops on many points is the shape
+        # B_elliptic runs fastest on), and the loops the rest: a small array on a grid
+        # runs about as a Solenoid's loop-by-loop 'elliptic', a large one on few points
+        # still takes many loops per block.
+        pairs = max(1, min(mem_limit // (32 * 8), 2**14))
+        chunk = min(bx.size, pairs)
+        mblock = min(M, max(1, pairs // chunk))
+
+        if profile is not None:
+            profile.add_time('grid setup', perf_counter() - t)
+
+        for start in range(0, bx.size, chunk):
+            if profile is not None:
+                t0 = perf_counter()
+            stop = min(start + chunk, bx.size)
+            i, j, k = np.unravel_index(np.arange(start, stop), shape)
+            x, y, z = X[i], Y[j], Z[k]
+
+            S = self.B_at(x, y, z, mblock)
+
+            if profile is not None:
+                t1 = perf_counter()
+            bx[start:stop] += S[0]
+            by[start:stop] += S[1]
+            bz[start:stop] += S[2]
+            if profile is not None:
+                profile.add_time('integration', t1 - t0)
+                profile.add_time('accumulation', perf_counter() - t1)
+                profile.count('evals', M*(stop - start))
+                profile.advance(M*(stop - start))
+        # end for start
+
+        return Bx, By, Bz
+    # end def
+
+    def B_at(self, x, y, z, mblock=32):
+        '''
+        The summed field at points x, y, z (1D arrays), mblock loops at a time.
+        Return an array (3, len(x)).
+        '''
+        M = len(self)
+        S = np.zeros((3, len(x)))
+        for m0 in range(0, M, mblock):
+            m1 = min(m0 + mblock, M)
+            # Rotation entries and centers as (loops, 1) columns
+            r = [[self.rot[m0:m1, a, b, None] for b in range(3)] for a in range(3)]
+            c = [self.centers[m0:m1, a, None] for a in range(3)]
+
+            # Into each loop's frame: (loops, points) arrays
+            dx = x - c[0]
+            dy = y - c[1]
+            dz = z - c[2]
+            if self.aligned[m0:m1].all():
+                # Loops along +z (e.g., a Solenoid's): their frames are only shifted.
+                Bl = B_elliptic(dx, dy, dz, self.R[m0:m1, None], self.I[m0:m1, None],
+                                self.mu0)
+                for a in range(3):
+                    S[a] += Bl[a].sum(axis=0)
+                continue
+            L = [r[a][0]*dx + r[a][1]*dy + r[a][2]*dz for a in range(3)]
+            del dx, dy, dz
+
+            Bl = B_elliptic(L[0], L[1], L[2], self.R[m0:m1, None], self.I[m0:m1, None],
+                            self.mu0)
+            del L
+
+            # Back to the global frame (the transpose), and sum over the loops.
+            for a in range(3):
+                S[a] += (r[0][a]*Bl[0] + r[1][a]*Bl[1] + r[2][a]*Bl[2]).sum(axis=0)
+        # end for m0
+
+        return S
+# end class
+
+
+def from_solenoid(s):
+    '''
+    The loops of a Solenoid as a CoilArray.
+    '''
+    Zs = np.asarray(s.Zs, dtype=float)
+    centers = np.stack([0*Zs, 0*Zs, Zs], axis=1)
+    return CoilArray(centers, (0, 0, 1), s.R, s.I, s.mu0)
+
+
+def as_coil_array(source):
+    '''
+    A CurrentLoop, a Solenoid or a CoilArray, as a CoilArray.
+    '''
+    if isinstance(source, CoilArray):
+        return source
+    if hasattr(source, 'Zs'):
+        return from_solenoid(source)
+    return CoilArray([0, 0, source.z], (0, 0, 1), source.R, source.I, source.mu0)
+
+
+def helmholtz(R, I, mu0, center=(0, 0, 0), normal=(0, 0, 1)):
+    '''
+    A Helmholtz pair: two loops of radius R, a distance R apart along normal,
+    carrying the same current I.
+    '''
+    n = np.asarray(normal, dtype=float)
+    n = n/np.linalg.norm(n)
+    c = np.asarray(center, dtype=float)
+    return CoilArray([c - n*R/2, c + n*R/2], n, R, I, mu0)
+
+
+if __name__ == '__main__':
+    import time
+    from math import pi
+    from P09111 import Solenoid
+
+    mu0 = 4e-7 * pi
+
+    # Test against Solenoid (the same loops, one at a time)
+    s = Solenoid(0.004, 1.8, mu0, 20, 0.01)
+    Xs = np.arange(-0.006, 0.006, 0.0005)
+    Zs = np.arange(-0.002, 0.012, 0.0005)
+    t = time.time()
+    B1 = s.compute_B(Xs, Xs, Zs, backend='elliptic', symmetry=False)
+    t1 = time.time() - t
+    t = time.time()
+    B2 = from_solenoid(s).compute_B(Xs, Xs, Zs)
+    t2 = time.time() - t
+    print('CoilArray vs Solenoid: {:.3f} s vs {:.3f} s, max abs. difference = {:.3e}'.format(
+          t2, t1, max(np.nanmax(np.abs(b1 - b2)) for b1, b2 in zip(B1, B2))))
+
+    # Test a tilted Helmholtz pair: the center field is (4/5)^(3/2) mu0 I/R along its axis.
+    R, I = 0.05, 2.0
+    n = np.array([1.0, 2.0, 2.0])/3
+    hp = helmholtz(R, I, mu0, center=(0.01, 0, 0), normal=n)
+    B = np.array([b[0, 0, 0] for b in hp.compute_B([0.01], [0], [0])])
+    print('Helmholtz center: B/|B| = {}, |B| rel. error = {:.3e}'.format(
+          B/np.linalg.norm(B), np.linalg.norm(B)/((4/5)**1.5*mu0*I/R) - 1))
+
+    # Test scaling: a 10 x 10 array of small coils
+    g = np.arange(10) * 0.01
+    centers = np.stack(np.meshgrid(g, g, [0.0], indexing='ij'), axis=-1).reshape(-1, 3)
+    ca = CoilArray(centers, (0, 0.3, 1), 0.004, 1.0, mu0)
+    Xs = np.linspace(-0.01, 0.1, 40)
+    t = time.time()
+    ca.compute_B(Xs, Xs, np.linspace(-0.01, 0.01, 10))
+    dt = time.time() - t
+    print('{} coils x {} points: {:.3f} s ({:.3e} pairs/s)'.format(
+          len(ca), 40*40*10, dt, len(ca)*40*40*10/dt))
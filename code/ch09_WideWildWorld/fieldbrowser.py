@@ -0,0 +1,299 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fieldrender import AXES, plane_frame
+
+# matplotlib is imported on first use (see figure): the slices can be computed without it.
+
+
+def stride(n, most):
+    '''
+    The step that keeps at most `most` of n points.
+    '''
+    return max(1, -(-n // most))
+
+
+class SliceBrowser:
+    '''
+    An interactive viewer of the field of a source (e.g., a CurrentLoop or a Solenoid)
+    on the grid X . Y . Z, one plane at a time, with sliders for the axis and the slice index.
+
+    A slice is computed on its own (only its points, downsampled to at most
+    max_pixels per side) and kept in an LRU cache of cache_size slices.
+    While one slice is shown, the next ones in the direction of scrubbing
+    are computed in a background thread (prefetch). A slice not cached nor prefetched
+    is computed on that same thread (and waited for), so the calls on the source
+    are never concurrent.
+    Moving the index slider redraws by blitting: the image data, the arrows
+    and the title are updated over a saved background; only a change of
+    axis redraws the whole figure.
+    '''
+
+    def __init__(self, source, X, Y, Z, axis=2, index=None, cache_size=64, max_pixels=128,
+                 arrows=24, prefetch=2, vmax=None, **settings):
+        '''
+        source: anything with compute_B(X, Y, Z, **settings).
+        X, Y, Z: field ranges along x, y, z-axes (uniform, for the image).
+        axis, index: the slice shown first (index None: the middle one).
+        cache_size: slices kept in the LRU cache.
+        max_pixels: the most points per side of a slice (in-plane axes are downsampled).
+        arrows: the most arrows per side.
+        prefetch: slices computed ahead in the background (0: none).
+        vmax: the top of the color scale (None: the 99th percentile of |B| on the first slice,
+              so a wire does not wash the image out). It stays fixed while scrubbing.
+        settings: compute_B options (N, backend, dtype, ...).
+        '''
+        self.source = source
+        self.grid = [np.asarray(A, dtype=float) for A in (X, Y, Z)]
+        self.settings = settings
+        self.axis = axis
+        self.index = len(self.grid[axis])//2 if index is None else index
+        self.cache_size = cache_size
+        self.max_pixels = max_pixels
+        self.arrows = arrows
+        self.prefetch = prefetch
+        self.vmax = vmax
+        self.cache = OrderedDict()      # (axis, index) -> Frame
+        self.pending = {}               # (axis, index) -> Future of a Frame
+        self.executor = ThreadPoolExecutor(max_workers=1)    # every compute, one at a time
+        self.direction = 1
+        self.hits = 0
+        self.prefetched = 0     # slices from (or still in) a prefetch
+        self.misses = 0
+        self.computed = 0       # grid points computed so far
+        self.fig = None
+
+    def axes_of(self, axis):
+        '''
+        The downsampled grid of the slices along axis (that axis in full).
+        '''
+        return [A if a == axis else A[::stride(len(A), self.max_pixels)]
+                for a, A in enumerate(self.grid)]
+
+    def compute(self, axis, index):
+        grid = self.axes_of(axis)
+        grid[axis] = self.grid[axis][index:index + 1]
+        B = self.source.compute_B(*grid, **self.settings)
+        return plane_frame(B, *grid, axis, 0), int(np.prod([len(A) for A in grid]))
+
+    def slice(self, axis, index):
+        '''
+        The Frame (see fieldrender) of the slice index along axis, from the cache
+        or a prefetch if there, computed otherwise (on the prefetch thread, behind
+        the prefetches already queued: the source is not thread-safe).
+        '''
+        key = (axis, index)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+
+        if key in self.pending:
+            self.prefetched += 1
+            frame, points = self.pending.pop(key).result()
+        else:
+            self.misses += 1
+            frame, points = self.executor.submit(self.compute, axis, index).result()
+        self.computed += points
+        self.remember(key, frame)
+        return frame
+
+    def remember(self, key, frame):
+        self.cache[key] = frame
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def ahead(self):
+        '''
+        Start computing the next slices in the direction of scrubbing, in the background.
+        '''
+        # Prefetches done meanwhile go to the cache (they count as computed).
+        for key in [k for k, f in self.pending.items() if f.done()]:
+            frame, points = self.pending.pop(key).result()
+            self.computed += points
+            self.remember(key, frame)
+
+        n = len(self.grid[self.axis])
+        for k in range(1, self.prefetch + 1):
+            i = self.index + k*self.direction
+            key = (self.axis, i)
+            if 0 <= i < n and key not in self.cache and key not in self.pending:
+                self.pending[key] = self.executor.submit(self.compute, self.axis, i)
+        # end for k
+
+    def arrow_uv(self, frame):
+        '''
+        Unit vectors of the in-plane field, at every arrow.
+        '''
+        s = self.qstep
+        Bh = frame.Bh[::s[0], ::s[1]].astype(float)
+        Bv = frame.Bv[::s[0], ::s[1]].astype(float)
+        norm = np.hypot(Bh, Bv)
+        norm[norm == 0] = 1
+        return (Bh/norm).T, (Bv/norm).T
+
+    def figure(self, fig=None):
+        '''
+        Build the viewer on a matplotlib figure (a new pyplot figure if None).
+        Return the figure.
+        '''
+        from matplotlib.widgets import Slider
+
+        if fig is None:
+            from matplotlib import pyplot as plt
+            fig = plt.figure(figsize=(7, 7))
+        self.fig = fig
+        self.ax = fig.add_axes([0.1, 0.22, 0.7, 0.7])
+        self.cax = fig.add_axes([0.82, 0.22, 0.03, 0.7])
+
+        n = len(self.grid[self.axis])
+        self.axis_slider = Slider(fig.add_axes([0.15, 0.1, 0.6, 0.03]), 'axis', 0, 2,
+                                  valinit=self.axis, valstep=1)
+        self.index_slider = Slider(fig.add_axes([0.15, 0.05, 0.6, 0.03]), 'index', 0, n - 1,
+                                   valinit=self.index, valstep=1)
+        # The sliders are redrawn by blit (see draw), not by a redraw of the whole figure.
+        self.axis_slider.drawon = False
+        self.index_slider.drawon = False
+        self.axis_slider.on_changed(self.on_axis)
+        self.index_slider.on_changed(self.on_index)
+
+        self.background = None
+        fig.canvas.mpl_connect('draw_event', self.on_draw)
+        self.setup_axis()
+        return fig
+
+    def setup_axis(self):
+        '''
+        (Re)build the image and the arrows for the slices along self.axis.
+        '''
+        frame = self.slice(self.axis, self.index)
+        if self.vmax is None:
+            self.vmax = float(np.nanpercentile(frame.mag, 99))
+
+        H, V = frame.H, frame.V
+        self.qstep = (stride(len(H), self.arrows), stride(len(V), self.arrows))
+        self.ax.clear()
+        self.cax.clear()
+        # origin='lower' and extent: the image in the plane's own coordinates.
+        self.image = self.ax.imshow(frame.mag.T, cmap='Reds', interpolation='nearest',
+                                    origin='lower', extent=[H[0], H[-1], V[0], V[-1]],
+                                    vmin=0, vmax=self.vmax, animated=True)
+        self.fig.colorbar(self.image, cax=self.cax, label='|B| (T)')
+        U, W = self.arrow_uv(frame)
+        self.quiver = self.ax.quiver(H[::self.qstep[0]], V[::self.qstep[1]], U, W,
+                                     pivot='middle', animated=True)
+        self.ax.set_xlabel(frame.labels[0])
+        self.ax.set_ylabel(frame.labels[1])
+        self.title = self.ax.set_title(frame.title, animated=True)
+        self.ax.set_aspect(1)
+
+        self.axis_slider.valtext.set_text(AXES[self.axis])
+        self.index_slider.valmax = len(self.grid[self.axis]) - 1
+        self.index_slider.ax.set_xlim(0, self.index_slider.valmax)
+        self.index_slider.set_val(self.index)
+
+    def on_draw(self, event):
+        '''
+        After a full redraw: save the background without the animated artists, then draw them.
+        '''
+        canvas = self.fig.canvas
+        self.background = canvas.copy_from_bbox(self.fig.bbox)
+        for artist in (self.image, self.quiver, self.title):
+            self.ax.draw_artist(artist)
+
+    def on_axis(self, value):
+        axis = int(value)
+        if axis == self.axis:
+            return
+        self.axis = axis
+        self.index = min(self.index, len(self.grid[axis]) - 1)
+        # The saved background is of the old axis: no blitting until the full redraw saves a new one.
+        self.background = None
+        self.setup_axis()
+        self.fig.canvas.draw_idle()
+
+    def on_index(self, value):
+        index = int(value)
+        if index == self.index and self.background is not None:
+            self.draw()
+            return
+        if index != self.index:
+            self.direction = 1 if index > self.index else -1
+        self.index = index
+        self.draw()
+
+    def draw(self):
+        '''
+        Show slice self.index: update the image data, the arrows and the title,
+        and blit them (and the index slider) over the saved background.
+        '''
+        frame = self.slice(self.axis, self.index)
+        self.image.set_data(frame.mag.T)
+        self.quiver.set_UVC(*self.arrow_uv(frame))
+        self.title.set_text(frame.title)
+        self.index_slider.valtext.set_text(str(self.index))
+
+        canvas = self.fig.canvas
+        if self.background is None:
+            canvas.draw_idle()
+        else:
+            canvas.restore_region(self.background)
+            for artist in (self.image, self.quiver, self.title):
+                self.ax.draw_artist(artist)
+            self.fig.draw_artist(self.index_slider.ax)
+            canvas.blit(self.fig.bbox)
+        self.ahead()
+
+    def show(self):
+        '''
+        Open the viewer in a window.
+        '''
+        from matplotlib import pyplot as plt
+
+        self.figure()
+        plt.show()
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+# end class
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    from math import pi
+    from P09111 import Solenoid
+
+    mu0 = 4e-7 * pi
+    s = Solenoid(0.004, 1.8, mu0, 20, 0.01)
+    Xs = np.linspace(-0.008, 0.008, 121)
+    Zs = np.linspace(-0.005, 0.015, 200)
+    # A cache as large as the volume: the way back is all cache hits (blitting only).
+    browser = SliceBrowser(s, Xs, Xs, Zs, axis=2, cache_size=256, N=100, backend='elliptic')
+
+    if '--scrub' not in sys.argv:
+        browser.show()
+        sys.exit()
+
+    # Headless: scrub through the 200 z-slices, then back, as a drag of the slider would.
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(7, 7))
+    FigureCanvasAgg(fig)
+    browser.figure(fig)
+    fig.canvas.draw()
+    for label, order in [('first pass', range(len(Zs))), ('back again', range(len(Zs))[::-1])]:
+        t = time.time()
+        for i in order:
+            browser.index_slider.set_val(i)
+        dt = time.time() - t
+        print('{}: {:.1f} slices/s; cache hits {}, prefetched {}, misses {}, points computed {}'.format(
+              label, len(Zs)/dt, browser.hits, browser.prefetched, browser.misses,
+              browser.computed))
+    # end for label
+    browser.close()
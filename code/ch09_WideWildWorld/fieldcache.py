@@ -0,0 +1,343 @@
+import os
+import copy
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+# compute_B options that do not change the result, so are not part of a key.
+IGNORED = ('workers', 'mem_limit', 'cache', 'add_to', 'profile', 'check')
+
+
+def volume_key(source, X, Y, Z, **settings):
+    '''
+    Hash of everything that determines a computed field volume.
+    source: a CurrentLoop, a Solenoid, a CoilArray or a Filament (anything with
+            I, mu0 and its geometry: R and loop positions Zs or z,
+            centers and normals, or wire points).
+    X, Y, Z: field ranges.
+    settings: compute_B options, with source.build_settings if it has them
+              (options fixed when it is built, e.g., a Treecode's leaf).
+    Return a hex digest.
+    '''
+    h = hashlib.sha256()
+    hash_source(h, source)
+
+    for A in (X, Y, Z):
+        A = np.asarray(A, dtype=float)
+        h.update(str(A.shape).encode())
+        h.update(A.tobytes())
+
+    hash_settings(h, dict(getattr(source, 'build_settings', {}), **settings))
+    return h.hexdigest()
+
+
+def hash_source(h, source):
+    '''
+    Update the hash h with the source's type, geometry, I and mu0.
+    '''
+    h.update(type(source).__name__.encode())
+
+    Zs = getattr(source, 'Zs', [getattr(source, 'z', 0.0)])
+    for v in (getattr(source, 'R', 0.0), source.I, source.mu0):
+        h.update(np.asarray(v, dtype=float).tobytes())
+    h.update(np.asarray(Zs, dtype=float).tobytes())
+    for name in ('centers', 'normals', 'points'):
+        if hasattr(source, name):
+            h.update(np.asarray(getattr(source, name), dtype=float).tobytes())
+
+
+def hash_settings(h, settings):
+    '''
+    Update the hash h with the compute_B options that change the result.
+    '''
+    for name in sorted(settings):
+        v = settings[name]
+        if name == 'dtype':
+            # float, np.float64, 'f8' are the same; float64 is the default.
+            v = np.dtype(v).name
+            if v == 'float64':
+                continue
+        if name not in IGNORED:
+            h.update('{}={!r};'.format(name, v).encode())
+
+
+class FieldCache:
+    '''
+    Content-addressed cache of computed field volumes (Bx, By, Bz).
+
+    A volume is keyed by a hash of everything that determines it:
+    the source geometry (R, I, mu0, loop positions), the X, Y, Z arrays,
+    and the compute_B settings (N, backend, ...).
+    Volumes are kept in two tiers:
+    * memory: the most recently used few volumes,
+    * disk: one <key>.npy file per volume under directory,
+      evicted least-recently-used first once the total exceeds max_bytes.
+    The integrand evaluations per point (source.evals, backend 'adaptive')
+    are kept with the volume, as a 4th component.
+    Arrays returned from the memory tier are shared: do not modify them in place.
+    '''
+
+    def __init__(self, directory='.fieldcache', max_bytes=2**30, mem_items=4):
+        '''
+        directory: where the .npy files are kept.
+        max_bytes: a size limit of the disk tier.
+        mem_items: a number of volumes kept in memory.
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mem_items = mem_items
+        self.mem = OrderedDict()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source, X, Y, Z, **settings):
+        return volume_key(source, X, Y, Z, **settings)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        '''
+        Return (Bx, By, Bz) for key (and evals, if stored with it), or None if it is not cached.
+        '''
+        if key in self.mem:
+            self.mem.move_to_end(key)
+            return self.mem[key]
+
+        fname = self.path(key)
+        if not os.path.exists(fname):
+            return None
+
+        B = tuple(np.load(fname))
+        os.utime(fname)             # mark as recently used
+        self.remember(key, B)
+        return B
+
+    def put(self, key, B):
+        '''
+        Store B = (Bx, By, Bz) (or (Bx, By, Bz, evals)) under key in both tiers.
+        '''
+        fname = self.path(key)
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, np.stack(B))
+        os.replace(tmp, fname)      # readers never see a partial file
+
+        self.remember(key, tuple(B))
+        self.evict()
+
+    def remember(self, key, B):
+        self.mem[key] = B
+        self.mem.move_to_end(key)
+        while len(self.mem) > self.mem_items:
+            self.mem.popitem(last=False)
+
+    def evict(self):
+        '''
+        Remove least-recently-used .npy files until the disk tier fits max_bytes.
+        '''
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                st = os.stat(os.path.join(self.directory, name))
+                files.append((st.st_mtime, st.st_size, name))
+        # end for name
+
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            self.mem.pop(name[:-len('.npy')], None)
+            total -= size
+        # end for
+
+    def clear(self):
+        self.mem.clear()
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                os.remove(os.path.join(self.directory, name))
+
+    def compute_B(self, source, X, Y, Z, **settings):
+        '''
+        source.compute_B(X, Y, Z, **settings), through the cache.
+        source.evals, if the computation sets it, is stored with the volume
+        and set again when the volume comes from the cache.
+        '''
+        key = self.key(source, X, Y, Z, **settings)
+        B = self.get(key)
+        if B is None:
+            B = tuple(source.compute_B(X, Y, Z, **settings))
+            evals = getattr(source, 'evals', None)
+            if evals is not None:
+                # In B's dtype: exact up to 2^24 evaluations per point in float32.
+                B = B + (np.asarray(evals).astype(B[0].dtype),)
+            self.put(key, B)
+
+        if len(B) == 4:
+            source.evals = B[3].astype(int)
+        return B[:3]
+# end class
+
+
+def unit_source(source):
+    '''
+    The source scaled to unit current and mu0 = 1, and the scale back.
+    source: a CurrentLoop, a Solenoid, a CoilArray or a Filament:
+            they read I and mu0 as they compute (a Treecode fixes its currents when built).
+    B is linear in I and mu0: source.compute_B = scale * unit.compute_B.
+    With several currents (a CoilArray), they are divided by the largest |I|,
+    so only their ratios are part of the unit source.
+    Return unit, scale (unit is None if every current is 0).
+    '''
+    if hasattr(source, 'trees'):
+        raise TypeError('a Treecode fixes its currents when built: '
+                        'cache the source it is built from')
+    I = np.asarray(source.I, dtype=float)
+    Iref = float(I) if I.ndim == 0 else float(np.max(np.abs(I), initial=0.0))
+    if Iref == 0 or source.mu0 == 0:
+        return None, 0.0
+
+    unit = copy.copy(source)
+    unit.I = source.I/Iref
+    unit.mu0 = 1.0
+    return unit, Iref*source.mu0
+
+
+def match(A, A0):
+    '''
+    Positions of the values of A in A0 (up to round-off), -1 where they are not in A0.
+    '''
+    tol = 1e-12 * max(1e-300, np.max(np.abs(A), initial=0), np.max(np.abs(A0), initial=0))
+    where = {int(q): n for n, q in enumerate(np.round(A0/tol))}
+    return np.array([where.get(int(q), -1) for q in np.round(A/tol)], dtype=np.intp)
+
+
+class UnitFieldCache:
+    '''
+    Fields per unit current (and mu0 = 1), kept per geometry and rescaled on the way out.
+
+    B is linear in I and in mu0, so a source's field is scale * (its unit field):
+    a sweep over the current (or mu0) computes the field once, and every other
+    operating point is one multiply per component.
+    For each geometry (and compute_B settings), the last grid is kept. A new grid
+    reuses the points it shares with it: only the new points are computed,
+    as up to three grid blocks (new x, then new y, then new z values).
+    Pass one as compute_B(..., cache=...), or call its compute_B.
+    self.computed counts the grid points computed so far.
+    '''
+
+    def __init__(self, mem_items=8):
+        '''
+        mem_items: a number of geometries kept (least recently used out first).
+        '''
+        self.mem_items = mem_items
+        self.mem = OrderedDict()
+        self.computed = 0
+
+    def key(self, unit, **settings):
+        '''
+        Hash of the unit source and the settings (not the grid).
+        '''
+        h = hashlib.sha256()
+        hash_source(h, unit)
+        hash_settings(h, settings)
+        return h.hexdigest()
+
+    def compute_B(self, source, X, Y, Z, **settings):
+        '''
+        source.compute_B(X, Y, Z, **settings), from the unit field.
+        '''
+        unit, scale = unit_source(source)
+        if unit is None:
+            return source.compute_B(X, Y, Z, **settings)
+
+        axes = [np.asarray(A, dtype=float) for A in (X, Y, Z)]
+        key = self.key(unit, **settings)
+        if key in self.mem:
+            self.mem.move_to_end(key)
+            B = self.extend(unit, self.mem[key], axes, settings)
+        else:
+            B = np.stack(unit.compute_B(*axes, **settings))
+            self.computed += B[0].size
+
+        self.mem[key] = (axes, B)
+        while len(self.mem) > self.mem_items:
+            self.mem.popitem(last=False)
+
+        return B[0]*scale, B[1]*scale, B[2]*scale
+
+    def extend(self, unit, known, axes, settings):
+        '''
+        The unit field on axes, from the known (axes, B) and the new points.
+        '''
+        axes0, B0 = known
+        pos = [match(A, A0) for A, A0 in zip(axes, axes0)]
+        if all(len(p) == len(A0) and np.array_equal(p, np.arange(len(p)))
+               for p, A0 in zip(pos, axes0)):
+            return B0
+
+        old = [p >= 0 for p in pos]
+
+        B = np.empty((3,) + tuple(len(A) for A in axes), dtype=B0.dtype)
+        ix = [np.nonzero(o)[0] for o in old]
+        if all(len(i) for i in ix):
+            B[(slice(None),) + np.ix_(*ix)] = B0[(slice(None),) + np.ix_(*[p[i] for p, i in zip(pos, ix)])]
+
+        # The new points: (new x) . Y . Z, (old x) . (new y) . Z, (old x) . (old y) . (new z)
+        everything = [np.arange(len(A)) for A in axes]
+        for a in range(3):
+            sel = ix[:a] + [np.nonzero(~old[a])[0]] + everything[a + 1:]
+            if not all(len(s) for s in sel):
+                continue
+            Bb = unit.compute_B(*[A[s] for A, s in zip(axes, sel)], **settings)
+            B[(slice(None),) + np.ix_(*sel)] = np.stack(Bb)
+            self.computed += Bb[0].size
+        # end for a
+
+        return B
+    # end def
+# end class
+
+
+if __name__ == '__main__':
+    import time
+    import tempfile
+    from math import pi
+    from P09111 import CurrentLoop
+
+    cache = FieldCache(tempfile.mkdtemp())
+    cl = CurrentLoop(0, 0.02, 3, 4e-7 * pi)
+    Xs = np.arange(-0.04, 0.04, 0.003)
+
+    for run in ['first', 'repeat', 'repeat (disk only)']:
+        if run == 'repeat (disk only)':
+            cache.mem.clear()
+        t = time.time()
+        Bx, By, Bz = cl.compute_B(Xs, Xs, Xs, N=100, cache=cache)
+        print('{} run: {:.4f} s'.format(run, time.time() - t))
+
+    # Current sweep: one unit field, then a multiply per operating point
+    from P09111 import Solenoid
+    ucache = UnitFieldCache()
+    Zs = np.arange(-0.002, 0.012, 0.0005)
+    Ys = np.arange(-0.006, 0.006, 0.0005)
+    t = time.time()
+    for I in np.linspace(0.1, 5, 200):
+        s = Solenoid(0.004, I, 4e-7 * pi, 20, 0.01)
+        B = s.compute_B([0.0], Ys, Zs, N=100, backend='numpy', cache=ucache)
+    dt = time.time() - t
+    B2 = s.compute_B([0.0], Ys, Zs, N=100, backend='numpy')
+    print('200 currents: {:.3f} s, {} points computed; max rel. difference = {:.3e}'.format(
+          dt, ucache.computed, max(np.max(np.abs(b1 - b2)) for b1, b2 in zip(B, B2))/np.max(np.abs(B2[2]))))
+
+    # A grid extended along z: only the new points are computed
+    Z2 = np.arange(-0.002, 0.016, 0.0005)
+    n = ucache.computed
+    B = s.compute_B([0.0], Ys, Z2, N=100, backend='numpy', cache=ucache)
+    B2 = s.compute_B([0.0], Ys, Z2, N=100, backend='numpy')
+    print('Extended grid: {} new points of {}; max rel. difference = {:.3e}'.format(
+          ucache.computed - n, B[0].size,
+          max(np.max(np.abs(b1 - b2)) for b1, b2 in zip(B, B2))/np.max(np.abs(B2[2]))))
@@ -0,0 +1,121 @@
+import json
+from time import perf_counter
+from contextlib import contextmanager
+
+
+class Profile:
+    '''
+    Instrumentation of a field computation: counters, stage timers and progress.
+
+    Pass one to integrate_n, BVec, CurrentLoop.compute_B or Solenoid.compute_B
+    (profile=...), or to unitvec in the visualization handouts.
+    * counts: e.g. 'evals' (integrand evaluations; one per point for the closed form)
+              and 'points' (grid points computed, summed over loops),
+    * times: seconds per stage: 'grid setup', 'integration', 'accumulation',
+             'unitvec', and 'workers' for a process-pool run as a whole,
+    * progress: callback(done, total, eta) with grid points x loops done so far,
+                at most once per interval seconds (and once at the end).
+    With profile=None (the default) none of this is done:
+    every hook is behind a single "if profile is not None".
+    '''
+
+    def __init__(self, callback=None, interval=0.5):
+        '''
+        callback: a function (done, total, eta in seconds), or None.
+        interval: the least time (seconds) between two callback calls.
+        '''
+        self.callback = callback
+        self.interval = interval
+        self.counts = {}
+        self.times = {}
+        self.total = 0
+        self.done = 0
+        self.t0 = None
+        self.t_last = None
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, stage, dt):
+        self.times[stage] = self.times.get(stage, 0.0) + dt
+
+    @contextmanager
+    def stage(self, name):
+        t = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - t)
+
+    def start(self, total):
+        '''
+        Begin a run of total work units (grid points x loops): progress and ETA
+        start over, even if the last run was cut short (e.g., by an error).
+        Only the outermost compute_B calls it; the loops of a Solenoid or a CoilArray
+        advance their run.
+        '''
+        self.total = total
+        self.done = 0
+        self.t0 = self.t_last = perf_counter()
+
+    def advance(self, n):
+        '''
+        Record n more work units done, and call the callback if it is due.
+        '''
+        self.done += n
+        self.count('points', n)
+        if self.callback is None:
+            return
+        t = perf_counter()
+        if t - self.t_last >= self.interval or self.done >= self.total:
+            self.t_last = t
+            self.callback(self.done, self.total, self.eta())
+
+    def eta(self):
+        '''
+        Seconds left at the average rate so far (None before any progress).
+        '''
+        if self.done == 0 or self.t0 is None:
+            return None
+        return (perf_counter() - self.t0)/self.done * max(0, self.total - self.done)
+
+    def report(self):
+        '''
+        Return the counters and timers as a dict.
+        '''
+        rep = {'counts': dict(self.counts), 'times': dict(self.times),
+               'done': self.done, 'total': self.total}
+        elapsed = sum(self.times.values())
+        if elapsed > 0 and 'evals' in self.counts:
+            rep['evals_per_s'] = self.counts['evals']/elapsed
+        return rep
+
+    def dump(self, fname):
+        '''
+        Write report() to a JSON file.
+        '''
+        with open(fname, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+# end class
+
+
+def print_progress(done, total, eta):
+    '''
+    A Profile callback: print percent done and ETA on one line.
+    '''
+    print('\r{:5.1f}% done, ETA {:.1f} s   '.format(100*done/max(1, total), eta or 0),
+          end='' if done < total else '\n', flush=True)
+
+
+if __name__ == '__main__':
+    import numpy as np
+    from math import pi
+    from P09111 import Solenoid
+
+    s = Solenoid(0.004, 1.8, 4e-7 * pi, 20, 0.01)
+    Xs = np.arange(-0.006, 0.006, 0.0003)
+    Zs = np.arange(-0.002, 0.012, 0.0003)
+
+    prof = Profile(print_progress, interval=0.2)
+    s.compute_B(Xs, Xs, Zs, N=100, backend='numpy', profile=prof)
+    print(json.dumps(prof.report(), indent=1))
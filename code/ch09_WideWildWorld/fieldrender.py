@@ -0,0 +1,223 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# matplotlib (and Pillow, for animate) are imported on first use, by the renderer only:
+# the compute-only entry points never pay for them.
+
+AXES = 'xyz'
+
+
+class Frame:
+    '''
+    One image: a plane of the field, in plot coordinates.
+    H, V: the coordinates along the horizontal and vertical axes of the image.
+    Bh, Bv: the in-plane field components, in shape (len(H), len(V)).
+    mag: |B| (all three components), in shape (len(H), len(V)).
+    labels: the names of the horizontal and vertical axes.
+    title: the title of the image.
+    marks: (h, v) arrays of points to mark (e.g., where the wires cross the plane), or None.
+    '''
+
+    def __init__(self, H, V, Bh, Bv, mag, labels, title, marks=None):
+        self.H = np.asarray(H, dtype=float)
+        self.V = np.asarray(V, dtype=float)
+        self.Bh = np.asarray(Bh)
+        self.Bv = np.asarray(Bv)
+        self.mag = np.asarray(mag)
+        self.labels = labels
+        self.title = title
+        self.marks = marks
+# end class
+
+
+def plane(B, axis, index):
+    '''
+    The plane index along axis of a field volume B: (Bx, By, Bz) arrays
+    (e.g., memory maps from fieldstore or fieldcache), or a fieldvolume.LazyVolume,
+    which then computes only that plane.
+    Return the three components in 2D.
+    '''
+    key = [slice(None)]*3
+    key[axis] = index
+    key = tuple(key)
+    if isinstance(B, (tuple, list)):
+        return tuple(np.asarray(Bc[key]) for Bc in B)
+    return B[key]
+
+
+def plane_frame(B, X, Y, Z, axis, index, scale=1.0, title=None, marks=None):
+    '''
+    A Frame of the plane index along axis of B (see plane), with the field times scale.
+    X, Y, Z: the grid of B.
+    '''
+    grid = (X, Y, Z)
+    h, v = [a for a in range(3) if a != axis]
+    Bp = plane(B, axis, index)
+    Bh = Bp[h]*scale
+    Bv = Bp[v]*scale
+    mag = np.sqrt(sum(Bc.astype(float)**2 for Bc in Bp))*abs(scale)
+    if title is None:
+        title = '{} = {:.4f}'.format(AXES[axis], grid[axis][index])
+    return Frame(grid[h], grid[v], Bh, Bv, mag, (AXES[h], AXES[v]), title, marks)
+
+
+def plane_frames(B, X, Y, Z, axis=2, planes=None, marks=None):
+    '''
+    Frames of the planes along axis (all of them if planes is None), e.g., every z-plane.
+    marks: as in Frame, or a function of the plane's coordinate returning them.
+    '''
+    grid = (X, Y, Z)
+    if planes is None:
+        planes = range(len(grid[axis]))
+    return [plane_frame(B, X, Y, Z, axis, i,
+                        marks=marks(grid[axis][i]) if callable(marks) else marks)
+            for i in planes]
+
+
+def ramp_frames(B, X, Y, Z, I, currents, axis=0, index=0, marks=None):
+    '''
+    Frames of one plane as the current ramps up: the field is linear in the current,
+    so the field B, computed at current I, is only rescaled to each of currents.
+    '''
+    return [plane_frame(B, X, Y, Z, axis, index, Ik/I,
+                        '{} = {:.4f}, I = {:.3g} A'.format(AXES[axis], (X, Y, Z)[axis][index], Ik),
+                        marks)
+            for Ik in currents]
+
+
+def draw(fig, frame, vmax=None, step=1, cmap='Reds'):
+    '''
+    Draw frame on the matplotlib Figure fig: |B| as an image,
+    the in-plane direction as arrows (every step-th point).
+    vmax: the top of the color scale (None: this frame's max |B|).
+    '''
+    ax = fig.add_subplot(1, 1, 1)
+    H, V = frame.H, frame.V
+    # origin='lower' and extent put the image in the plane's own coordinates:
+    # no flipping of the y-axis, as imshow needs otherwise.
+    extent = [H[0], H[-1], V[0], V[-1]]
+    im = ax.imshow(frame.mag.T, cmap=cmap, interpolation='nearest', origin='lower',
+                   extent=extent, vmin=0, vmax=vmax)
+    fig.colorbar(im, ax=ax, label='|B| (T)')
+
+    # Unit vectors of the in-plane field
+    Bh = frame.Bh[::step, ::step].astype(float)
+    Bv = frame.Bv[::step, ::step].astype(float)
+    norm = np.hypot(Bh, Bv)
+    norm[norm == 0] = 1
+    ax.quiver(H[::step], V[::step], (Bh/norm).T, (Bv/norm).T, pivot='middle')
+
+    if frame.marks is not None:
+        ax.plot(frame.marks[0], frame.marks[1], 'y.')
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+    ax.locator_params(nbins=5)
+    ax.set_xlabel(frame.labels[0])
+    ax.set_ylabel(frame.labels[1])
+    ax.set_title(frame.title)
+    ax.set_aspect(1)
+
+
+def render_job(frames, fnames, vmax, step, cmap, dpi, size):
+    '''
+    Render frames to fnames (PNG) with the Agg canvas: no window, no pyplot state.
+    '''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    for frame, fname in zip(frames, fnames):
+        fig = Figure(figsize=size)
+        FigureCanvasAgg(fig)
+        draw(fig, frame, vmax, step, cmap)
+        fig.savefig(fname, dpi=dpi)
+    # end for frame
+
+    return fnames
+
+
+def render(frames, directory, prefix='frame', workers=1, vmax='common', step=1, cmap='Reds',
+           dpi=100, size=(6, 5), per_job=8):
+    '''
+    Write frames (Frame) to PNG files directory/prefix_0000.png, ... .
+    workers: a number of processes rendering at once (1: in this process).
+    vmax: the top of the color scale: 'common' (the max |B| over all frames,
+          so an animation does not flicker), None (per frame) or a value.
+    step: draw an arrow at every step-th point.
+    cmap, dpi, size: the colormap, resolution and figure size (inches).
+    per_job: frames per task sent to a worker process.
+    Return the file names, in the order of frames.
+    '''
+    frames = list(frames)
+    os.makedirs(directory, exist_ok=True)
+    fnames = [os.path.join(directory, '{}_{:04d}.png'.format(prefix, n))
+              for n in range(len(frames))]
+    if isinstance(vmax, str):
+        vmax = max((float(np.nanmax(f.mag)) for f in frames if np.isfinite(f.mag).any()),
+                   default=None)
+
+    jobs = [(frames[n:n + per_job], fnames[n:n + per_job], vmax, step, cmap, dpi, size)
+            for n in range(0, len(frames), per_job)]
+    if workers == 1:
+        for job in jobs:
+            render_job(*job)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            # Wait for every job, and raise the first error if any.
+            for _ in ex.map(render_job, *zip(*jobs)):
+                pass
+        # end with ex
+
+    return fnames
+
+
+def animate(fnames, fname, fps=10, loop=0):
+    '''
+    Assemble PNG frames (e.g., from render) into an animated GIF fname.
+    fps: frames per second.
+    loop: times to repeat (0: forever).
+    '''
+    from PIL import Image
+
+    images = [Image.open(f).convert('RGB') for f in fnames]
+    images[0].save(fname, save_all=True, append_images=images[1:],
+                   duration=int(round(1000/fps)), loop=loop)
+    return fname
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import tempfile
+    from math import pi
+    from P09111 import Solenoid
+
+    mu0 = 4e-7 * pi
+    s = Solenoid(0.004, 1.8, mu0, 20, 0.01)
+    Xs = np.linspace(-0.008, 0.008, 33)
+    Zs = np.linspace(-0.004, 0.014, 37)
+    B = s.compute_B(Xs, Xs, Zs, N=100, backend='numpy')
+    print('matplotlib imported by the computation: {}'.format('matplotlib' in sys.modules))
+
+    # Every z-plane through the solenoid; the wire crossings are marked on those of a loop.
+    def wires(z):
+        th = np.linspace(0, 2*pi, 60)
+        if np.min(np.abs(np.array(s.Zs) - z)) < (Zs[1] - Zs[0])/2:
+            return s.R*np.cos(th), s.R*np.sin(th)
+        return None
+
+    d = tempfile.mkdtemp()
+    frames = plane_frames(B, Xs, Xs, Zs, axis=2, marks=wires)
+    for workers in [1, 2]:
+        t = time.time()
+        fnames = render(frames, os.path.join(d, 'z{}'.format(workers)), 'z', workers, step=2)
+        print('{} z-planes with {} worker(s): {:.2f} s'.format(len(fnames), workers,
+                                                               time.time() - t))
+
+    # The x = 0 plane as the current ramps up, as an animation
+    Ik = np.linspace(0.1, 1.8, 12)
+    fnames = render(ramp_frames(B, Xs, Xs, Zs, s.I, Ik, axis=0, index=16),
+                    os.path.join(d, 'ramp'), 'ramp', step=2)
+    gif = animate(fnames, os.path.join(d, 'ramp.gif'), fps=4)
+    print('Animation: {} ({} bytes, {} frames)'.format(gif, os.path.getsize(gif), len(fnames)))
@@ -0,0 +1,111 @@
+import os
+import json
+
+import numpy as np
+
+from fieldcache import volume_key
+
+
+def write_manifest(fname, manifest):
+    '''
+    Write the manifest atomically: a crash leaves either the old one or the new one.
+    '''
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, fname)
+
+
+def compute_B_memmap(source, X, Y, Z, directory, slab_bytes=64*2**20, **settings):
+    '''
+    Compute source.compute_B(X, Y, Z, **settings) out of core, into .npy files.
+    source: a CurrentLoop or a Solenoid.
+    X, Y, Z: field ranges along x, y, z-axes.
+    directory: where Bx.npy, By.npy, Bz.npy and manifest.json are written.
+    slab_bytes: a size of a slab of (Bx, By, Bz); sets how many x-planes go in a slab.
+    settings: compute_B options (N, backend, mem_limit, ...); the files get settings['dtype'].
+
+    The volume is computed slab by slab along X. Each slab is added in place
+    straight into the memory-mapped files (compute_B(..., add_to=...)),
+    so neither the volume nor a per-turn copy of it is ever held in RAM.
+    After a slab is flushed to disk, it is recorded in manifest.json.
+    Running again with the same source, grid and settings resumes
+    from the first unfinished slab; anything else starts over.
+    Return Bx, By, Bz as read-only memory maps.
+    '''
+
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    Z = np.asarray(Z, dtype=float)
+    shape = (len(X), len(Y), len(Z))
+
+    os.makedirs(directory, exist_ok=True)
+    names = [os.path.join(directory, c + '.npy') for c in ('Bx', 'By', 'Bz')]
+    fmanifest = os.path.join(directory, 'manifest.json')
+
+    key = volume_key(source, X, Y, Z, **settings)
+    dtype = np.dtype(settings.get('dtype', float))
+    planes = max(1, slab_bytes // (3 * dtype.itemsize * len(Y) * len(Z)))
+    slabs = [[lo, min(lo + planes, len(X))] for lo in range(0, len(X), planes)]
+
+    manifest = None
+    if os.path.exists(fmanifest) and all(os.path.exists(f) for f in names):
+        with open(fmanifest) as f:
+            manifest = json.load(f)
+        if manifest['key'] != key or manifest['slabs'] != slabs:
+            manifest = None
+
+    if manifest is None:
+        # A fresh run: new (zero-filled) files.
+        manifest = {'key': key, 'shape': list(shape), 'slabs': slabs, 'done': []}
+        Bs = [np.lib.format.open_memmap(f, mode='w+', dtype=dtype, shape=shape)
+              for f in names]
+        write_manifest(fmanifest, manifest)
+    else:
+        Bs = [np.lib.format.open_memmap(f, mode='r+') for f in names]
+
+    done = set(manifest['done'])
+    for n, (lo, hi) in enumerate(slabs):
+        if n in done:
+            continue
+
+        # An interrupted slab may hold a partial sum: start it from zero.
+        for B in Bs:
+            B[lo:hi] = 0
+        source.compute_B(X[lo:hi], Y, Z, add_to=tuple(B[lo:hi] for B in Bs),
+                         **settings)
+        for B in Bs:
+            B.flush()
+
+        manifest['done'].append(n)
+        write_manifest(fmanifest, manifest)
+    # end for n
+
+    del Bs
+    return tuple(np.load(f, mmap_mode='r') for f in names)
+
+
+if __name__ == '__main__':
+    import time
+    import tempfile
+    from math import pi
+    from P09111 import Solenoid
+
+    d = tempfile.mkdtemp()
+    s = Solenoid(0.004, 1.8, 4e-7 * pi, 10, 0.01)
+    Xs = np.arange(-0.006, 0.006, 0.0003)
+    Zs = np.arange(-0.002, 0.012, 0.0003)
+
+    t = time.time()
+    Bx, By, Bz = compute_B_memmap(s, Xs, Xs, Zs, d, slab_bytes=2**20,
+                                  N=100, backend='numpy')
+    print('First run: {:.3f} s'.format(time.time() - t))
+
+    t = time.time()
+    Bx, By, Bz = compute_B_memmap(s, Xs, Xs, Zs, d, slab_bytes=2**20,
+                                  N=100, backend='numpy')
+    print('Resumed (all slabs done): {:.3f} s'.format(time.time() - t))
+
+    B2 = s.compute_B(Xs, Xs, Zs, N=100, backend='numpy')
+    print('Max abs. difference to the in-memory result:',
+          max(np.max(np.abs(b1 - b2)) for b1, b2 in zip((Bx, By, Bz), B2)))
@@ -0,0 +1,366 @@
+import numpy as np
+
+from P09111 import GridPoints
+
+
+# The 27 nodes of a cell: 3 x 3 x 3, node 9a + 3b + c at (a, b, c)/2 of the cell.
+NODES = np.array([(a, b, c) for a in range(3) for b in range(3) for c in range(3)])
+# The 8 children (octants): child 4a + 2b + c at (a, b, c)/2 of the cell.
+OCTANTS = np.array([(a, b, c) for a in range(2) for b in range(2) for c in range(2)])
+CORNERS = 9*2*OCTANTS[:, 0] + 3*2*OCTANTS[:, 1] + 2*OCTANTS[:, 2]
+
+
+def trilinear_weights():
+    '''
+    (27, 8) weights of the trilinear interpolant from the 8 corners at the 27 nodes.
+    '''
+    t = NODES/2
+    W = np.ones((27, 8))
+    for o, (a, b, c) in enumerate(OCTANTS):
+        for axis, e in enumerate((a, b, c)):
+            W[:, o] *= t[:, axis] if e else 1 - t[:, axis]
+    # end for o
+    return W
+
+
+class FieldTree:
+    '''
+    An adaptively sampled field: an octree of cells over the box [lo, hi],
+    kept in flat arrays (see build):
+    * corner: (n, 3) the lowest corner of each cell, on the finest lattice
+              (2^(max_depth + 1) steps per axis),
+    * depth: (n,) the depth of each cell (the root is 0),
+    * child: (n,) the first of the 8 children of each cell (in octant order), -1 for a leaf,
+    * nodes: (n, 27) each cell's 3 x 3 x 3 samples, as rows of P and B,
+    * err: (n,) the error estimate of each cell: a quarter of the largest |B - B_trilinear|
+           over its nodes, with B_trilinear from the cell's 8 corners,
+    * P, B: (m, 3) the sample points and the field there.
+    The children of a cell come one after another, so a point finds its leaf
+    in max_depth vectorized steps.
+    Within a leaf, B is trilinear on the octant of the 3 x 3 x 3 samples around the point:
+    half the step of B_trilinear, so a quarter of its error (the error goes as step^2).
+    Points outside the box get nan; so do points next to nan samples (e.g., on a wire).
+    '''
+
+    def __init__(self, lo, hi, max_depth, corner, depth, child, nodes, err, P, B):
+        self.lo = np.asarray(lo, dtype=float)
+        self.hi = np.asarray(hi, dtype=float)
+        self.max_depth = int(max_depth)
+        self.corner = corner
+        self.depth = depth
+        self.child = child
+        self.nodes = nodes
+        self.err = err
+        self.P = P
+        self.B = B
+        self.n = 2**(self.max_depth + 1)
+
+    def __len__(self):
+        return len(self.child)
+
+    def leaves(self):
+        '''
+        The indices of the leaf cells.
+        '''
+        return np.flatnonzero(self.child < 0)
+
+    def size(self, c):
+        '''
+        The edge of cells c in finest-lattice units.
+        '''
+        return self.n >> self.depth[c].astype(np.intp)
+
+    def save(self, fname):
+        '''
+        Write the tree to fname (.npz), for load.
+        '''
+        np.savez(fname, lo=self.lo, hi=self.hi, max_depth=self.max_depth, corner=self.corner,
+                 depth=self.depth, child=self.child, nodes=self.nodes, err=self.err,
+                 P=self.P, B=self.B)
+
+    def lattice(self, P):
+        '''
+        Points P (M, 3) in finest-lattice units, and a mask of those inside the box.
+        '''
+        u = (np.asarray(P, dtype=float).reshape(-1, 3) - self.lo)*(self.n/(self.hi - self.lo))
+        inside = np.all((u >= 0) & (u <= self.n), axis=1)
+        return u, inside
+
+    def locate(self, P):
+        '''
+        The leaf cell of each point P (M, 3); -1 outside the box.
+        '''
+        u, inside = self.lattice(P)
+        return self.leaf_of(u, inside)
+
+    def leaf_of(self, u, inside):
+        c = np.where(inside, 0, -1)
+        active = np.flatnonzero(inside)
+        for d in range(self.max_depth):
+            active = active[self.child[c[active]] >= 0]
+            if len(active) == 0:
+                break
+            ca = c[active]
+            # The octant of each point around its cell's center
+            mid = self.corner[ca] + (self.n >> (d + 1))
+            o = (u[active] >= mid) @ np.array([4, 2, 1])
+            c[active] = self.child[ca] + o
+        # end for d
+        return c
+
+    def __call__(self, P, chunk=65536):
+        '''
+        B at points P.
+        P: (M, 3) point coordinates.
+        chunk: points per batch (keeps the work arrays small).
+        Return B (M, 3).
+        '''
+        P = np.asarray(P, dtype=float).reshape(-1, 3)
+        out = np.empty((len(P), 3))
+        for start in range(0, len(P), chunk):
+            stop = min(start + chunk, len(P))
+            self.interpolate(P[start:stop], out[start:stop])
+        # end for start
+        return out
+
+    def interpolate(self, P, out):
+        '''
+        Trilinear interpolation at points P (m, 3) into out (m, 3).
+        '''
+        u, inside = self.lattice(P)
+        c = self.leaf_of(u, inside)
+        cc = np.maximum(c, 0)
+
+        # Position within the leaf in half-cells: the octant h and w in [0, 1] within it
+        s = 2.0*(u - self.corner[cc])/self.size(cc)[:, None]
+        h = np.clip(np.floor(s), 0, 1).astype(np.intp)
+        w = s - h
+
+        out[:] = 0
+        for a, b, e in OCTANTS:
+            node = 9*(h[:, 0] + a) + 3*(h[:, 1] + b) + (h[:, 2] + e)
+            wt = ((w[:, 0] if a else 1 - w[:, 0]) * (w[:, 1] if b else 1 - w[:, 1])
+                  * (w[:, 2] if e else 1 - w[:, 2]))
+            out += wt[:, None] * self.B[self.nodes[cc, node]]
+        # end for a, b, e
+
+        out[c < 0] = np.nan
+
+    def to_grid(self, X, Y, Z, chunk=65536):
+        '''
+        The tree resampled on the grid X . Y . Z (e.g., for plotting).
+        Return Bx, By, Bz in shape (len(X), len(Y), len(Z)).
+        '''
+        G = GridPoints(X, Y, Z)
+        B = np.empty((3, len(G)))
+        for start in range(0, len(G), chunk):
+            stop = min(start + chunk, len(G))
+            B[:, start:stop] = self(G[start:stop], chunk).T
+        # end for start
+        return tuple(Bc.reshape(G.grid_shape) for Bc in B)
+# end class
+
+
+class Sampler:
+    '''
+    The samples of build: a sorted table of lattice keys, so a node shared by
+    several cells (and levels) is evaluated once.
+    '''
+
+    def __init__(self, source, lo, hi, max_depth, settings):
+        self.source = source
+        self.lo = np.asarray(lo, dtype=float)
+        self.hi = np.asarray(hi, dtype=float)
+        self.n = 2**(max_depth + 1)
+        self.settings = settings
+        self.keys = np.zeros(0, dtype=np.int64)     # sorted
+        self.rows = np.zeros(0, dtype=np.intp)      # row of P, B of each key
+        self.P = np.zeros((0, 3))
+        self.B = np.zeros((0, 3))
+
+    def node_keys(self, corner, depth):
+        '''
+        Lattice keys of the 27 nodes of cells (corner (m, 3), depth (m,)): (m, 27).
+        '''
+        half = (self.n >> depth) // 2
+        L = corner[:, None, :] + NODES[None, :, :]*half[:, None, None]
+        return (L[..., 0]*(self.n + 1) + L[..., 1])*(self.n + 1) + L[..., 2]
+
+    def known(self, keys):
+        pos = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        if len(self.keys) == 0:
+            return np.zeros(keys.shape, dtype=bool), pos
+        return self.keys[pos] == keys, pos
+
+    def sample(self, keys):
+        '''
+        Evaluate the keys not known yet; return the rows of all of them.
+        '''
+        found, _ = self.known(keys)
+        new = np.unique(keys[~found])
+        if len(new):
+            L = np.stack([new // (self.n + 1)**2, new // (self.n + 1) % (self.n + 1),
+                          new % (self.n + 1)], axis=1)
+            P = self.lo + L*((self.hi - self.lo)/self.n)
+            B = np.asarray(self.source.compute_B_points(P, **self.settings), dtype=float)
+
+            rows = np.concatenate([self.rows, len(self.P) + np.arange(len(new))])
+            keys_all = np.concatenate([self.keys, new])
+            order = np.argsort(keys_all, kind='stable')
+            self.keys = keys_all[order]
+            self.rows = rows[order]
+            self.P = np.concatenate([self.P, P])
+            self.B = np.concatenate([self.B, B])
+
+        _, pos = self.known(keys)
+        return self.rows[pos]
+# end class
+
+
+def build(source, lo, hi, rtol=1e-2, atol=0.0, max_depth=7, max_points=2**20, min_depth=2,
+          **settings):
+    '''
+    Sample source's field on an octree over the box [lo, hi], refined where
+    trilinear interpolation is poor, i.e., where the field bends (near wires, at solenoid ends).
+    source: anything with compute_B_points(P, **settings), e.g., a CurrentLoop or a Solenoid.
+    lo, hi: the corners of the box (3 values each).
+    rtol, atol: a cell is split while its error estimate (see FieldTree) exceeds
+                atol + rtol*(the largest |B| at its nodes).
+    max_depth: the deepest level (the finest cells are 2^-max_depth of the box per axis).
+    max_points: a budget of field evaluations: once it would be exceeded, no more cells
+                are split (the cells with the largest errors go first, level by level).
+    min_depth: levels split regardless of the error estimate, so the first samples
+               do not miss a small feature (a loop in a large box).
+    settings: compute_B_points options (N, backend, ...).
+
+    Each cell is sampled at 3 x 3 x 3 nodes; its 8 children reuse those as their corners,
+    so a split costs at most 8 x 19 new evaluations, all of a level in one compute_B_points call.
+    Return a FieldTree.
+    '''
+    if min_depth > max_depth:
+        raise ValueError('min_depth must not exceed max_depth')
+    if max_depth > 19:
+        raise ValueError('max_depth must be 19 or less (lattice keys are int64)')
+    sampler = Sampler(source, lo, hi, max_depth, settings)
+    n = sampler.n
+    W = trilinear_weights()
+
+    corner = [np.zeros((1, 3), dtype=np.int64)]
+    depth = [np.zeros(1, dtype=np.int8)]
+    child = []
+    nodes = []
+    err = []
+    count = 1       # cells so far
+
+    for d in range(max_depth + 1):
+        C = corner[-1]
+        m = len(C)
+        rows = sampler.sample(sampler.node_keys(C, np.full(m, d)))
+        nodes.append(rows)
+
+        # Error of the trilinear interpolant from the corners, at the other 19 nodes,
+        # scaled to the half step of the octants
+        V = sampler.B[rows]                                     # (m, 27, 3)
+        D = V - np.einsum('nk,mkc->mnc', W, V[:, CORNERS])
+        E = np.sqrt(np.sum(D*D, axis=2)).max(axis=1)/4
+        scale = np.sqrt(np.sum(V*V, axis=2)).max(axis=1)
+        err.append(E)
+
+        ch = np.full(m, -1, dtype=np.int64)
+        split = np.zeros(m, dtype=bool) if d == max_depth else ~(E <= atol + rtol*scale)
+        if d < min_depth:
+            split[:] = True
+        cand = np.flatnonzero(split)
+
+        if len(cand) and d >= min_depth:
+            # Worst first (nan first: a wire), as many as the budget allows
+            cand = cand[np.argsort(-np.nan_to_num(E[cand], nan=np.inf), kind='stable')]
+            kids = (C[cand][:, None, :] + OCTANTS[None, :, :]*((n >> d)//2)).reshape(-1, 3)
+            keys = sampler.node_keys(kids, np.full(len(kids), d + 1)).reshape(len(cand), -1)
+            found, _ = sampler.known(keys)
+            flat = np.where(found, -1, keys).ravel()
+            _, first = np.unique(flat, return_index=True)
+            first = first[flat[first] >= 0]
+            cost = np.bincount(first // keys.shape[1], minlength=len(cand))
+            cand = cand[:np.searchsorted(np.cumsum(cost), max_points - len(sampler.P), 'right')]
+
+        if len(cand) == 0:
+            child.append(ch)
+            break
+        cand = np.sort(cand)
+        ch[cand] = count + 8*np.arange(len(cand))
+        count += 8*len(cand)
+        child.append(ch)
+        corner.append((C[cand][:, None, :] + OCTANTS[None, :, :]*((n >> d)//2)).reshape(-1, 3))
+        depth.append(np.full(8*len(cand), d + 1, dtype=np.int8))
+    # end for d
+
+    # int32 indices and lattice coordinates: the arrays stay compact
+    return FieldTree(lo, hi, max_depth, np.concatenate(corner[:len(child)]).astype(np.int32),
+                     np.concatenate(depth[:len(child)]), np.concatenate(child).astype(np.int32),
+                     np.concatenate(nodes).astype(np.int32), np.concatenate(err),
+                     sampler.P, sampler.B)
+
+
+def load(fname):
+    '''
+    A FieldTree saved with FieldTree.save.
+    '''
+    f = np.load(fname)
+    return FieldTree(f['lo'], f['hi'], int(f['max_depth']), f['corner'], f['depth'],
+                     f['child'], f['nodes'], f['err'], f['P'], f['B'])
+
+
+if __name__ == '__main__':
+    import time
+    import tempfile
+    from math import pi
+    from P09111 import CurrentLoop, Solenoid, B_elliptic
+    from fieldmap import from_source
+
+    mu0 = 4e-7 * pi
+    cl = CurrentLoop(0, 0.02, 3, mu0)
+
+    # The box of viz_currentloop, against a uniform grid with as many points:
+    # the tree spends them near the wire, where the uniform grid's worst errors are.
+    lo, hi = (-0.04, -0.04, -0.04), (0.04, 0.04, 0.04)
+    t = time.time()
+    tree = build(cl, lo, hi, rtol=3e-2, max_depth=7, max_points=2**18, backend='elliptic')
+    dt = time.time() - t
+    print('Tree: {} points, {} leaves, depth {} in {:.3f} s'.format(
+          len(tree.P), len(tree.leaves()), tree.depth.max(), dt))
+
+    n = int(round(len(tree.P)**(1/3)))
+    Xs = np.linspace(-0.04, 0.04, n)
+    fm = from_source(cl, Xs, Xs, Xs, backend='elliptic')
+
+    # Accuracy at random points at least 1 mm off the wire
+    P = np.random.RandomState(0).uniform(lo, hi, (2*10**5, 3))
+    P = P[np.hypot(np.hypot(P[:, 0], P[:, 1]) - 0.02, P[:, 2]) > 0.001]
+    Be = np.stack(B_elliptic(P[:, 0], P[:, 1], P[:, 2], 0.02, 3, mu0), axis=1)
+    t = time.time()
+    Bt = tree(P)
+    dq = time.time() - t
+    for name, B in [('tree', Bt), ('uniform {}^3'.format(n), fm(P))]:
+        e = np.sqrt(np.sum((B - Be)**2, axis=1))/np.sqrt(np.sum(Be**2, axis=1))
+        print('{}: rel. error median {:.3e}, 99.9th percentile {:.3e}, max {:.3e}, nan {}'.format(
+              name, np.nanmedian(e), np.nanpercentile(e, 99.9), np.nanmax(e), np.isnan(e).sum()))
+    print('Tree lookup: {:.2e} points/s'.format(len(P)/dq))
+
+    # Resampled on the uniform grid; saved and loaded
+    Bx, By, Bz = tree.to_grid(Xs, Xs, Xs)
+    d = tempfile.mkdtemp()
+    tree.save(d + '/tree.npz')
+    same = np.array_equal(load(d + '/tree.npz')(P[:1000]), Bt[:1000])
+    print('to_grid: shape {}; saved and loaded: same result {}'.format(Bx.shape, same))
+
+    # A solenoid: the finest cells gather at the winding (rho = R, 0 <= z <= L)
+    s = Solenoid(0.004, 1.8, mu0, 20, 0.01)
+    tree = build(s, (-0.008, -0.008, -0.005), (0.008, 0.008, 0.015), rtol=1e-2, max_depth=6,
+                 max_points=40000, backend='elliptic')
+    leaf = tree.leaves()
+    finest = leaf[tree.depth[leaf] == tree.depth.max()]
+    c = tree.lo + (tree.corner[finest] + tree.size(finest)[:, None]/2)*(tree.hi - tree.lo)/tree.n
+    d = np.hypot(np.hypot(c[:, 0], c[:, 1]) - 0.004, np.fmax(0, np.fmax(-c[:, 2], c[:, 2] - 0.01)))
+    print('Solenoid: {} points; {} finest leaves, {:.0f}% within 1 mm of the winding'.format(
+          len(tree.P), len(finest), 100*np.mean(d < 0.001)))
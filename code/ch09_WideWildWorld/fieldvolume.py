@@ -0,0 +1,105 @@
+import numpy as np
+
+
+class LazyVolume:
+    '''
+    The field volume source.compute_B(X, Y, Z, **settings), computed on demand, by planes.
+
+    Indexing works as on Bx, By, Bz and returns the three of them:
+        Bx, By, Bz = vol[:, :, 13]        # the plane z = Z[13] only
+        Bx, By, Bz = vol[0]               # the plane x = X[0]
+        Bx, By, Bz = vol[:, [14, 19, 21]] # three y-planes
+    The planes are taken along an axis indexed by an integer (or a list of them),
+    preferably one whose planes are all known already; with slices only,
+    along the axis with the fewest points selected.
+    Every plane is computed once, with one compute_B call for all the planes
+    missing from a request, and kept: a later request reuses it.
+    self.computed counts the grid points computed so far.
+    '''
+
+    def __init__(self, source, X, Y, Z, **settings):
+        '''
+        source: anything with compute_B(X, Y, Z, **settings), e.g., a CurrentLoop or a Solenoid.
+        X, Y, Z: field ranges along x, y, z-axes.
+        settings: compute_B options (N, backend, dtype, ...).
+        '''
+        self.source = source
+        self.axes = [np.asarray(A, dtype=float) for A in (X, Y, Z)]
+        self.settings = settings
+        self.shape = tuple(len(A) for A in self.axes)
+        self.planes = {}        # (axis, index) -> (Bx, By, Bz) of that plane
+        self.computed = 0
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 3 or any(k is Ellipsis for k in key):
+            raise IndexError('index with up to 3 integers, slices or lists (no ...)')
+        key = key + (slice(None),)*(3 - len(key))
+
+        # The points selected on each axis
+        sel = [np.arange(n)[k] for n, k in zip(self.shape, key)]
+        picked = [a for a in range(3) if not isinstance(key[a], slice)]
+        known = [a for a in picked or range(3)
+                 if all((a, int(i)) in self.planes for i in np.atleast_1d(sel[a]))]
+        if known:
+            axis = known[0]
+        elif picked:
+            axis = picked[0]
+        else:
+            axis = int(np.argmin([np.size(s) for s in sel]))
+        idx = np.atleast_1d(sel[axis])
+
+        self.compute(axis, idx)
+        block = [np.stack([self.planes[(axis, i)][c] for i in idx], axis=axis)
+                 for c in range(3)]
+
+        # The rest of the key, on the block (its planes are idx, in order).
+        rest = list(key)
+        rest[axis] = 0 if np.ndim(sel[axis]) == 0 else slice(None)
+        return tuple(Bc[tuple(rest)] for Bc in block)
+
+    def compute(self, axis, idx):
+        '''
+        Compute the planes idx along axis that are not known yet.
+        '''
+        todo = [i for i in dict.fromkeys(int(i) for i in idx) if (axis, i) not in self.planes]
+        if not todo:
+            return
+
+        grid = list(self.axes)
+        grid[axis] = self.axes[axis][todo]
+        B = self.source.compute_B(*grid, **self.settings)
+        self.computed += int(np.prod([len(A) for A in grid]))
+
+        for n, i in enumerate(todo):
+            self.planes[(axis, i)] = tuple(np.take(Bc, n, axis=axis) for Bc in B)
+    # end def
+# end class
+
+
+if __name__ == '__main__':
+    import time
+    from math import pi
+    from P09111 import CurrentLoop
+
+    cl = CurrentLoop(0, 0.02, 3, 4e-7 * pi)
+    Xs = np.arange(-0.04, 0.04, 0.003)
+
+    # The planes cl_viz draws, against the whole volume
+    t = time.time()
+    B = cl.compute_B(Xs, Xs, Xs, N=100, backend='numpy')
+    t_full = time.time() - t
+
+    t = time.time()
+    vol = LazyVolume(cl, Xs, Xs, Xs, N=100, backend='numpy')
+    err = 0
+    for key in [(slice(None), slice(None), [13, 14, 26]), (slice(None), [14, 19, 21])]:
+        for b, bl in zip(B, vol[key]):
+            err = max(err, np.max(np.abs(b[key] - bl)))
+    t_lazy = time.time() - t
+
+    print('Lazy planes: {} of {} points in {:.3f} s (full volume: {:.3f} s); max abs. difference = {}'.format(
+          vol.computed, B[0].size, t_lazy, t_full, err))
+    print('Point (1, 2, 13) from a known plane: {}; points computed still {}'.format(
+          np.allclose([b[1, 2, 13] for b in B], vol[1, 2, 13]), vol.computed))
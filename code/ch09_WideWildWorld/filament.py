@@ -0,0 +1,196 @@
+from math import pi
+from time import perf_counter
+
+import numpy as np
+
+from P09111 import grid_out, compute_B_parallel
+
+
+def B_segments(x, y, z, A, B, I, mu0):
+    '''
+    Closed-form field of straight current segments (Biot-Savart, exact for a segment).
+    x, y, z: arrays of point coordinates, broadcastable with the segment arrays.
+    A, B: the start and end of each segment, as 3 arrays (ax, ay, az), (bx, by, bz).
+          The current I flows from A to B.
+    I, mu0: the current and the permeability of free space.
+
+    With r1 = P - A, r2 = P - B:
+        dB = mu0 I/(4 pi) (r1 x r2) (|r1| + |r2|) / (|r1| |r2| (|r1| |r2| + r1 . r2))
+    On the segment itself, the field is undefined: B is nan.
+    Return Bx, By, Bz.
+    '''
+
+    r1x, r1y, r1z = x - A[0], y - A[1], z - A[2]
+    r2x, r2y, r2z = x - B[0], y - B[1], z - B[2]
+    n1 = np.sqrt(r1x*r1x + r1y*r1y + r1z*r1z)
+    n2 = np.sqrt(r2x*r2x + r2y*r2y + r2z*r2z)
+    n12 = n1*n2
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        f = mu0*I/(4*pi) * (n1 + n2)/(n12*(n12 + r1x*r2x + r1y*r2y + r1z*r2z))
+        return (f*(r1y*r2z - r1z*r2y),
+                f*(r1z*r2x - r1x*r2z),
+                f*(r1x*r2y - r1y*r2x))
+
+
+class Filament:
+    '''
+    A thin wire along a polyline, carrying current I from its first point to its last.
+    Every straight segment contributes its exact field (B_segments),
+    so the coil geometry (helix pitch, leads, ...) is taken as it is.
+    '''
+
+    def __init__(self, points, I, mu0):
+        '''
+        points: (K + 1, 3) vertices of the wire path (K segments).
+        I: a current flowing along the path.
+        mu0: permeability of free space
+        '''
+        self.points = np.ascontiguousarray(np.reshape(points, (-1, 3)), dtype=float)
+        self.I = I
+        self.mu0 = mu0
+
+    def __len__(self):
+        return len(self.points) - 1
+
+    def compute_B(self, X, Y, Z, mem_limit=256*2**20, workers=1, cache=None,
+                  add_to=None, profile=None):
+        '''
+        X, Y, Z: field ranges along x, y, z-axes
+        mem_limit: a bound (in bytes) on the working (segment, point) arrays.
+        workers, cache, add_to, profile: see CurrentLoop.compute_B
+
+        The (segment, point) pairs are evaluated in blocks of segments x blocks of points,
+        at most 2^13 pairs per block so the work arrays stay in cache;
+        a block of points is finished over all segments before the next one.
+        Return Bx, By, Bz in shape (len(X), len(Y), len(Z)).
+        '''
+
+        if cache is not None or workers > 1:
+            if cache is not None:
+                B = cache.compute_B(self, X, Y, Z, mem_limit=mem_limit,
+                                    workers=workers, profile=profile)
+            else:
+                t = perf_counter()
+                B = compute_B_parallel(self, X, Y, Z, workers, mem_limit=mem_limit)
+                if profile is not None:
+                    profile.add_time('workers', perf_counter() - t)
+            if add_to is None:
+                return B
+            for A, Bc in zip(add_to, B):
+                A += Bc
+            return add_to
+
+        if profile is not None:
+            t = perf_counter()
+            profile.start(len(self)*len(X)*len(Y)*len(Z))
+
+        X = np.asarray(X, dtype=float)
+        Y = np.asarray(Y, dtype=float)
+        Z = np.asarray(Z, dtype=float)
+        shape = (len(X), len(Y), len(Z))
+        (Bx, By, Bz), (bx, by, bz) = grid_out(shape, add_to)
+
+        # Segment ends as (segments, 1) columns
+        A = [self.points[:-1, a, None] for a in range(3)]
+        B = [self.points[1:, a, None] for a in range(3)]
+
+        K = len(self)
+        # Roughly 20 float64 temporaries per (segment, point) pair.
+        pairs = max(1, min(mem_limit // (20 * 8), 2**13))
+        kblock = min(K, max(1, pairs // 256))
+        chunk = max(1, pairs // kblock)
+
+        if profile is not None:
+            profile.add_time('grid setup', perf_counter() - t)
+
+        for start in range(0, bx.size, chunk):
+            if profile is not None:
+                t0 = perf_counter()
+            stop = min(start + chunk, bx.size)
+            i, j, k = np.unravel_index(np.arange(start, stop), shape)
+            x, y, z = X[i], Y[j], Z[k]
+
+            S = np.zeros((3, stop - start))
+            for k0 in range(0, K, kblock):
+                k1 = min(k0 + kblock, K)
+                dB = B_segments(x, y, z, [a[k0:k1] for a in A], [b[k0:k1] for b in B],
+                                self.I, self.mu0)
+                for a in range(3):
+                    S[a] += dB[a].sum(axis=0)
+            # end for k0
+
+            if profile is not None:
+                t1 = perf_counter()
+            bx[start:stop] += S[0]
+            by[start:stop] += S[1]
+            bz[start:stop] += S[2]
+            if profile is not None:
+                profile.add_time('integration', t1 - t0)
+                profile.add_time('accumulation', perf_counter() - t1)
+                profile.count('evals', K*(stop - start))
+                profile.advance(K*(stop - start))
+        # end for start
+
+        return Bx, By, Bz
+    # end def
+# end class
+
+
+def helix(R, turns, L, segments_per_turn=128, lead=0.0):
+    '''
+    Vertices of a helical coil on the z-axis, from z = 0 to z = L.
+    R: a radius of the helix.
+    turns: a number of turns (need not be an integer).
+    L: a length of the coil.
+    segments_per_turn: a number of straight segments per turn.
+    lead: a length of straight lead wires, going radially outwards
+          from both ends of the helix (0 for none).
+    The helix winds counter-clockwise looking from +z, as does a Solenoid with I > 0.
+    Return (K + 1, 3) points.
+    '''
+
+    n = max(1, int(np.ceil(turns*segments_per_turn)))
+    t = np.linspace(0, 1, n + 1)
+    theta = 2*pi*turns*t
+    P = np.stack([R*np.cos(theta), R*np.sin(theta), L*t], axis=1)
+
+    if lead > 0:
+        u0 = np.array([np.cos(theta[0]), np.sin(theta[0]), 0])
+        u1 = np.array([np.cos(theta[-1]), np.sin(theta[-1]), 0])
+        P = np.vstack([P[0] + lead*u0, P, P[-1] + lead*u1])
+
+    return P
+
+
+if __name__ == '__main__':
+    import time
+    from P09111 import Solenoid, B_elliptic
+
+    mu0 = 4e-7 * pi
+
+    # Test: a closed 2000-gon against the closed-form field of a circular loop
+    th = np.linspace(0, 2*pi, 2001)
+    ring = Filament(np.stack([0.02*np.cos(th), 0.02*np.sin(th), 0*th], axis=1), 3, mu0)
+    Xs = np.linspace(-0.04, 0.04, 9)
+    B1 = ring.compute_B(Xs, Xs, Xs + 0.001)
+    x, y, z = np.meshgrid(Xs, Xs, Xs + 0.001, indexing='ij')
+    B2 = B_elliptic(x, y, z, 0.02, 3, mu0)
+    print('2000-gon vs circular loop: max rel. error = {:.3e}'.format(
+          max(np.max(np.abs(b1 - b2)) for b1, b2 in zip(B1, B2))/np.max(np.abs(B2[2]))))
+
+    # Helix vs the ring approximation
+    R, I, turns, L = 0.004, 1.8, 20, 0.01
+    f = Filament(helix(R, turns, L), I, mu0)
+    s = Solenoid(R, I, mu0, turns + 1, L)
+    Xs = np.linspace(-0.006, 0.006, 25)
+    Zs = np.linspace(-0.002, 0.012, 29)
+    t = time.time()
+    Bh = f.compute_B(Xs, Xs, Zs)
+    dt = time.time() - t
+    Br = s.compute_B(Xs, Xs, Zs, backend='elliptic')
+    print('Helix: {} segments x {} points in {:.3f} s'.format(len(f), Bh[0].size, dt))
+    print('Helix vs rings at the center: Bz {:.4e} vs {:.4e} T; |B_transverse| {:.3e} vs {:.3e} T'.format(
+          Bh[2][12, 12, 14], Br[2][12, 12, 14],
+          np.hypot(Bh[0][12, 12, 14], Bh[1][12, 12, 14]),
+          np.hypot(Br[0][12, 12, 14], Br[1][12, 12, 14])))
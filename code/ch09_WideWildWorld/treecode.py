@@ -0,0 +1,607 @@
+from math import comb, pi
+from time import perf_counter
+
+import numpy as np
+
+from P09111 import B_elliptic, grid_out, compute_B_parallel
+from coilarray import CoilArray, as_coil_array, from_solenoid
+
+
+def coaxial_groups(ca, tol=1e-12):
+    '''
+    Split the loops of a CoilArray into groups sharing one axis.
+    Return a list of (o, e, d, R, I, m):
+        o, e: a point on the axis and the axis direction (unit vector),
+        d: the loop positions along the axis (o + d e are the centers),
+        R, I: radii and currents (I flipped if the loop's normal is -e),
+        m: the loops' indices in ca.
+    '''
+    e = ca.normals.copy()
+    I = ca.I.copy()
+    # One direction per axis: the first nonzero component positive.
+    first = np.argmax(np.abs(e) > 1e-9, axis=1)
+    flip = e[np.arange(len(e)), first] < 0
+    e[flip] *= -1
+    I[flip] *= -1
+
+    d = np.einsum('ij,ij->i', ca.centers, e)
+    o = ca.centers - d[:, None]*e
+
+    scale = max(1e-300, np.max(np.abs(ca.centers)), np.max(ca.R))
+    keys = np.round(np.hstack([e, o/scale])/tol).astype(np.int64)
+    _, inv = np.unique(keys, axis=0, return_inverse=True)
+
+    groups = []
+    for g in range(inv.max() + 1):
+        m = np.nonzero(inv.reshape(-1) == g)[0]
+        m = m[np.argsort(d[m])]
+        groups.append((o[m[0]], e[m[0]], d[m], ca.R[m], I[m], m))
+    # end for g
+
+    return groups
+
+
+def zonal_coefficients(d0, d, R, I, order):
+    '''
+    Far-field (r > c) expansion of coaxial loops about the point d0 on their axis:
+        Phi(r, theta) = sum_n a_n P_n(cos theta)/r^(n+1),  B = -mu0 grad Phi,
+    where r, theta are measured from d0 and the axis.
+    A loop at distance c = sqrt((d - d0)^2 + R^2) and angle alpha (cos alpha = (d - d0)/c) has
+        a_n = I R^2 c^(n-1) P'_n(cos alpha) / (2 (n+1)),
+    from the generating function of P'_n applied to the on-axis field (see Bcloop).
+    Return a_0 .. a_order (a_0 = 0: no monopole).
+    '''
+    c = np.hypot(d - d0, R)
+    x = (d - d0)/c
+
+    a = np.zeros(order + 1)
+    Pm, P = np.zeros_like(x), np.ones_like(x)       # P_{n-1}, P_n
+    dP = np.zeros_like(x)                           # P'_n
+    for n in range(1, order + 1):
+        dP = n*P + x*dP                             # P'_n = n P_{n-1} + x P'_{n-1}
+        Pm, P = P, ((2*n - 1)*x*P - (n - 1)*Pm)/n
+        a[n] = np.sum(I*R*R*c**(n - 1)*dP)/(2*(n + 1))
+    # end for n
+
+    return a
+
+
+def zonal_field(a, ds, rho, mu0):
+    '''
+    Field of the expansion a (see zonal_coefficients) at axial offsets ds, radii rho.
+    Return B along the axis and B along rho.
+    '''
+    r = np.hypot(ds, rho)
+    u = ds/r
+    v = rho/r
+    ir = 1/r
+
+    Br = np.zeros_like(r)
+    Bt = np.zeros_like(r)
+    Pm, P = np.ones_like(u), u.copy()               # P_{n-1}, P_n
+    dP = np.ones_like(u)                            # P'_n
+    irn = ir*ir*ir                                  # 1/r^(n+2)
+    for n in range(1, len(a)):
+        if a[n] != 0:
+            Br += (n + 1)*a[n]*P*irn
+            Bt += a[n]*dP*irn
+        dP = (n + 1)*P + u*dP
+        Pm, P = P, ((2*n + 1)*u*P - n*Pm)/(n + 1)
+        irn *= ir
+    # end for n
+    Br *= mu0
+    Bt *= mu0*v
+
+    return Br*u - Bt*v, Br*v + Bt*u
+
+
+def acceptance(order, tol):
+    '''
+    The largest q = c/r for which the expansion of the given order is trusted:
+    the tail sum_(n > order) n^2/4 q^(n-1) (relative to the dipole term) is below tol.
+    '''
+    q = 0.0
+    for t in np.linspace(0.01, 0.9, 90):
+        n = np.arange(order + 1, order + 400)
+        if np.sum(n*n/4*t**(n - 1)) <= tol:
+            q = t
+    # end for t
+    return q
+
+
+def multi_indices(n):
+    '''
+    The multi-indices (i, j, k) of degree 0 .. n, degree by degree (1, x, y, z, xx, xy, ...).
+    Return them as a (K, 3) array, and a lookup array: pos[i, j, k] is the position of (i, j, k).
+    '''
+    A = np.array([(i, j, d - i - j) for d in range(n + 1) for i in range(d, -1, -1)
+                  for j in range(d - i, -1, -1)], dtype=np.intp)
+    pos = np.zeros((n + 1,)*3, dtype=np.intp)
+    pos[A[:, 0], A[:, 1], A[:, 2]] = np.arange(len(A))
+    return A, pos
+
+
+def cartesian_tables(order):
+    '''
+    Index tables of the Cartesian expansions of the given multipole order (1: dipole,
+    2: dipole and quadrupole, ...): moments of degree 0 .. order - 1 (Kb of them),
+    Taylor coefficients of 1/r of degree 0 .. order + 1 (K of them).
+    Return a dict:
+        A: the multi-indices (K, 3),
+        K, Kb: the numbers of Taylor coefficients and of moments (per component),
+        levels: per degree d of the Taylor recurrence, (d, lo, hi, one, two):
+                rows lo .. hi - 1 are of degree d; one[i], two[i] are the rows of
+                alpha - e_i, alpha - 2 e_i (K, a zero row, where they do not exist),
+        field: the (3 K, 3 Kb) matrix from moments to field coefficients
+               (see cartesian_coefficients),
+        shift: rows, columns, binomial factors and monomial rows of the moment shift
+               (see shift_moments).
+    '''
+    n = order + 1
+    A, pos = multi_indices(n)
+    K = len(A)
+    Kb = order*(order + 1)*(order + 2)//6
+    E = np.eye(3, dtype=np.intp)
+
+    def rows(B):
+        # Positions of the multi-indices B (..., 3); K where a component is negative.
+        ok = np.all(B >= 0, axis=-1)
+        B = np.maximum(B, 0)
+        return np.where(ok, pos[B[..., 0], B[..., 1], B[..., 2]], K)
+
+    levels = []
+    for d in range(1, n + 1):
+        lo, hi = d*(d + 1)*(d + 2)//6, (d + 1)*(d + 2)*(d + 3)//6
+        levels.append((d, lo, hi, rows(A[None, lo:hi] - E[:, None]),
+                       rows(A[None, lo:hi] - 2*E[:, None])))
+    # end for d
+
+    # F[delta, l] = (-1)^|delta| delta_l gamma_i mu[gamma - e_i, i], gamma = delta - e_l
+    field = np.zeros((K, 3, Kb, 3))
+    sign = (-1.0)**A.sum(axis=1)
+    for l in range(3):
+        for i in range(3):
+            G = A - E[l]
+            b = rows(G - E[i])
+            ok = b < Kb
+            field[np.nonzero(ok)[0], l, b[ok], i] = (sign*A[:, l]*G[:, i])[ok]
+    # end for l
+
+    # Binomial shift: mu'[beta] = sum_(alpha <= beta) C(beta, alpha) s^(beta - alpha) mu[alpha]
+    Ab = A[:Kb]
+    D = Ab[:, None] - Ab[None, :]
+    r, c = np.nonzero(np.all(D >= 0, axis=-1))
+    pascal = np.array([[comb(a, b) for b in range(order)] for a in range(order)], dtype=float)
+    shift = (r, c, np.prod(pascal[Ab[r], Ab[c]], axis=1), rows(D[r, c]))
+
+    return {'A': A, 'K': K, 'Kb': Kb, 'levels': levels,
+            'field': field.reshape(3*K, 3*Kb), 'shift': shift}
+
+
+def monomials(D, A):
+    '''
+    The monomials D^alpha for the multi-indices A (K, 3) at the offsets D (3, m).
+    Return a (K, m) array.
+    '''
+    pw = np.ones((A.max() + 1,) + D.shape)
+    for k in range(1, len(pw)):
+        pw[k] = pw[k - 1]*D
+    return pw[A[:, 0], 0]*pw[A[:, 1], 1]*pw[A[:, 2], 2]
+
+
+def disk_moments(loops, C, tables):
+    '''
+    Moments about C of a CoilArray's loops, of degree 0 .. order - 1:
+        mu[beta, i] = sum over the loops of I n_i integral over the disk of (r - C)^beta dA.
+    Outside any sphere about C that holds the wires, a loop's field is that of
+    a uniform dipole layer I n on its flat disk, and these are its moments.
+    The integrals are exact: Gauss-Legendre along the radius, equal steps around.
+    Return a (Kb, 3) array.
+    '''
+    Kb = tables['Kb']
+    p = tables['A'][Kb - 1].sum()        # the highest degree
+    x, w = np.polynomial.legendre.leggauss((p + 3)//2)
+    rho = (x + 1)/2
+    wr = w*rho/2                        # integral of f(rho) rho drho over [0, 1]
+    th = 2*pi*np.arange(p + 1)/(p + 1)
+
+    # Quadrature points relative to C (loops, radii, angles, 3), and their dipole moments
+    u = (rho[:, None]*np.cos(th))[..., None]
+    v = (rho[:, None]*np.sin(th))[..., None]
+    e1, e2, n = [loops.rot[:, a, None, None, :] for a in range(3)]
+    D = (loops.centers - C)[:, None, None, :] + loops.R[:, None, None, None]*(u*e1 + v*e2)
+    W = np.broadcast_to(wr[:, None]*(2*pi/len(th)), u.shape[:2])
+    M = (loops.R**2*loops.I)[:, None, None, None]*W[..., None]*n
+
+    return monomials(D.reshape(-1, 3).T, tables['A'][:Kb]) @ M.reshape(-1, 3)
+
+
+def shift_moments(mu, s, tables):
+    '''
+    Moments mu about a point C + s, moved to C.
+    '''
+    r, c, binom, expo = tables['shift']
+    ms = monomials(np.reshape(s, (3, 1)), tables['A'])[:, 0]
+    S = np.zeros((tables['Kb'], tables['Kb']))
+    S[r, c] = binom*ms[expo]
+    return S @ mu
+
+
+def cartesian_coefficients(mu, tables, mu0):
+    '''
+    Field coefficients F (K, 3) of the moments mu: B = F^T a, with a the Taylor
+    coefficients of 1/r at the offset from the center (see cartesian_field).
+    The scalar potential of the layer is (1/4 pi) sum_i,beta (-1)^|beta| mu[beta, i] D_i D^beta (1/r)/beta!,
+    and B = -mu0 grad of it.
+    '''
+    return (mu0/(4*pi))*(tables['field'] @ mu.reshape(-1)).reshape(-1, 3)
+
+
+def taylor_coefficients(R, tables):
+    '''
+    Taylor coefficients a_alpha = D^alpha (1/|R|)/alpha! at offsets R (3, m), by the recurrence
+        |alpha| R^2 a_alpha + (2 |alpha| - 1) sum_i R_i a_(alpha - e_i)
+                            + (|alpha| - 1) sum_i a_(alpha - 2 e_i) = 0.
+    Return a (K + 1, m) array (the last row is 0).
+    '''
+    a = np.zeros((tables['K'] + 1, R.shape[1]))
+    r2 = np.sum(R*R, axis=0)
+    a[0] = 1/np.sqrt(r2)
+    ir2 = 1/r2
+    for d, lo, hi, one, two in tables['levels']:
+        s = R[0]*a[one[0]]
+        s += R[1]*a[one[1]]
+        s += R[2]*a[one[2]]
+        s *= 2*d - 1
+        if d > 1:
+            s += (d - 1)*(a[two[0]] + a[two[1]] + a[two[2]])
+        s *= -ir2/d
+        a[lo:hi] = s
+    # end for d
+    return a
+
+
+def cartesian_field(F, R, tables):
+    '''
+    Field of the coefficients F (see cartesian_coefficients) at offsets R (3, m)
+    from the center. Return B (3, m).
+    '''
+    return F.T @ taylor_coefficients(R, tables)[:tables['K']]
+
+
+class Treecode:
+    '''
+    Field of many loops with a hierarchical far-field (multipole) approximation.
+
+    Loops sharing an axis are sorted along it and put in a binary tree
+    of clusters (leaf loops per leaf). Each cluster has a zonal multipole expansion
+    about its middle (zonal_coefficients), valid outside the sphere of radius c
+    around it that holds all its wires. A target point uses the expansion of a cluster
+    when c/r <= acceptance(order, tol), and otherwise goes down to the children;
+    at a leaf, the loops are evaluated directly (B_elliptic).
+    Targets far from a group then cost O(log(loops)) instead of O(loops).
+
+    Coaxial groups of leaf loops or fewer (tilted or scattered coils, Helmholtz pairs,
+    most CoilArrays) would each cost every point a visit. Their loops go into one
+    general tree instead: clusters split in halves across their widest extent,
+    with Cartesian multipole expansions about their centers (dipole, quadrupole, ...,
+    up to general_order; see cartesian_tables), moments of the leaves from their loops
+    (disk_moments), of the other clusters shifted up from their children (shift_moments).
+    The same acceptance test applies, with general_order; near the leaves,
+    the loops are evaluated directly (CoilArray.B_at). An expansion costs about
+    as much as K/12 loops (K Taylor coefficients, 220 for order 8), so it is only
+    used for clusters with more loops than that.
+    '''
+
+    def __init__(self, source, leaf=8):
+        '''
+        source: a CurrentLoop, a Solenoid or a CoilArray.
+        leaf: the most loops in a leaf cluster.
+        '''
+        source = as_coil_array(source)
+
+        # Geometry, also what fieldcache.volume_key hashes
+        self.centers = source.centers
+        self.normals = source.normals
+        self.R = source.R
+        self.I = source.I
+        self.mu0 = source.mu0
+        # Options fixed when built, also part of the fieldcache key
+        self.build_settings = {'leaf': leaf}
+
+        self.leaf = leaf
+        groups = coaxial_groups(source)
+        if len(groups) > 1:
+            general = np.concatenate([g[5] for g in groups if len(g[2]) <= leaf]
+                                     + [np.zeros(0, dtype=np.intp)])
+            groups = [g for g in groups if len(g[2]) > leaf]
+        else:
+            general = np.zeros(0, dtype=np.intp)
+        self.groups = groups
+        self.trees = [self.build(g[2], g[3], 0, len(g[2])) for g in self.groups]
+        self.general = self.build_general(source, general, 0, len(general)) if len(general) else None
+
+    def __len__(self):
+        return len(self.centers)
+
+    def build(self, d, R, lo, hi):
+        '''
+        Cluster [lo, hi) of a group's loops (sorted by d): [lo, hi, d0, c, children].
+        '''
+        d0 = (d[lo] + d[hi - 1])/2
+        c = np.max(np.hypot(d[lo:hi] - d0, R[lo:hi]))
+        children = []
+        if hi - lo > self.leaf:
+            mid = (lo + hi)//2
+            children = [self.build(d, R, lo, mid), self.build(d, R, mid, hi)]
+        return [lo, hi, d0, c, children]
+
+    def build_general(self, ca, m, lo, hi):
+        '''
+        Cluster [lo, hi) of the general loops (indices m into ca, reordered in place):
+        [lo, hi, C, c, children, loops], C the center, c the radius of a sphere about C
+        that holds the wires, loops the leaf's loops as a CoilArray (None above the leaves).
+        '''
+        P = ca.centers[m[lo:hi]]
+        C = (P.min(axis=0) + P.max(axis=0))/2
+        c = np.max(np.sqrt(np.sum((P - C)**2, axis=1)) + ca.R[m[lo:hi]])
+        if hi - lo <= self.leaf:
+            k = m[lo:hi]
+            return [lo, hi, C, c, [], CoilArray(ca.centers[k], ca.normals[k], ca.R[k], ca.I[k],
+                                                ca.mu0)]
+
+        a = np.argmax(P.max(axis=0) - P.min(axis=0))
+        m[lo:hi] = m[lo:hi][np.argsort(P[:, a], kind='stable')]
+        mid = (lo + hi)//2
+        children = [self.build_general(ca, m, lo, mid), self.build_general(ca, m, mid, hi)]
+        return [lo, hi, C, c, children, None]
+
+    def compute_B(self, X, Y, Z, tol=1e-10, order=20, general_order=None, mem_limit=256*2**20,
+                  workers=1, cache=None, add_to=None, profile=None):
+        '''
+        X, Y, Z: field ranges along x, y, z-axes
+        tol: bound on each cluster's truncation error, relative to its dipole field
+             (for general clusters: to the field of its loops' dipoles, in magnitude).
+        order: the highest multipole order used in the coaxial groups.
+        general_order: the highest multipole order used in the general tree
+                       (2: dipole and quadrupole); the work per expansion grows as its cube.
+                       None: 8 for tol 1e-3, 10 for 1e-6, at most 12 (about the fastest).
+        mem_limit, workers, cache, add_to, profile: see CurrentLoop.compute_B
+
+        Return Bx, By, Bz in shape (len(X), len(Y), len(Z)).
+        '''
+
+        if cache is not None or workers > 1:
+            if cache is not None:
+                B = cache.compute_B(self, X, Y, Z, tol=tol, order=order,
+                                    general_order=general_order, mem_limit=mem_limit,
+                                    workers=workers, profile=profile)
+            else:
+                t = perf_counter()
+                B = compute_B_parallel(self, X, Y, Z, workers, tol=tol, order=order,
+                                       general_order=general_order, mem_limit=mem_limit)
+                if profile is not None:
+                    profile.add_time('workers', perf_counter() - t)
+            if add_to is None:
+                return B
+            for A, Bc in zip(add_to, B):
+                A += Bc
+            return add_to
+
+        if profile is not None:
+            t = perf_counter()
+            profile.start(len(X)*len(Y)*len(Z))
+
+        X = np.asarray(X, dtype=float)
+        Y = np.asarray(Y, dtype=float)
+        Z = np.asarray(Z, dtype=float)
+        shape = (len(X), len(Y), len(Z))
+        (Bx, By, Bz), (bx, by, bz) = grid_out(shape, add_to)
+
+        if general_order is None:
+            general_order = int(min(12, 6 + round(-np.log10(tol)/1.5)))
+        q = acceptance(order, tol)
+        coefs = [self.coefficients(tree, g, order) for tree, g in zip(self.trees, self.groups)]
+        # Leaves are evaluated on (leaf, points) arrays of about 32 float64 temporaries.
+        per_point = 32*self.leaf
+        if self.general is not None:
+            tables = cartesian_tables(general_order)
+            qg = acceptance(general_order, tol)
+            gcoefs = {}
+            self.moments(self.general, tables, gcoefs)
+            # An expansion makes (K + 1, points) Taylor coefficients, and as many temporaries.
+            per_point = max(per_point, 2*(tables['K'] + 1))
+        chunk = max(1, mem_limit // (8*per_point))
+
+        if profile is not None:
+            profile.add_time('grid setup', perf_counter() - t)
+
+        for start in range(0, bx.size, chunk):
+            if profile is not None:
+                t0 = perf_counter()
+            stop = min(start + chunk, bx.size)
+            i, j, k = np.unravel_index(np.arange(start, stop), shape)
+            P = np.stack([X[i], Y[j], Z[k]], axis=1)
+
+            S = np.zeros((stop - start, 3))
+            for tree, (o, e, d, R, I, _), a in zip(self.trees, self.groups, coefs):
+                s = (P - o) @ e
+                rv = P - o - s[:, None]*e
+                rho = np.sqrt(np.sum(rv*rv, axis=1))
+                Bax, Brho, evals = self.traverse(tree, a, q, s, rho, d, R, I)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    ur = np.where(rho[:, None] > 0, rv/rho[:, None], 0.0)
+                S += Bax[:, None]*e + Brho[:, None]*ur
+                if profile is not None:
+                    profile.count('evals', evals)
+            # end for tree
+            if self.general is not None:
+                Bg, evals = self.traverse_general(self.general, gcoefs, qg, P.T, tables)
+                S += Bg.T
+                if profile is not None:
+                    profile.count('evals', evals)
+
+            if profile is not None:
+                t1 = perf_counter()
+            bx[start:stop] += S[:, 0]
+            by[start:stop] += S[:, 1]
+            bz[start:stop] += S[:, 2]
+            if profile is not None:
+                profile.add_time('integration', t1 - t0)
+                profile.add_time('accumulation', perf_counter() - t1)
+                profile.advance(stop - start)
+        # end for start
+
+        return Bx, By, Bz
+    # end def
+
+    def coefficients(self, tree, group, order):
+        '''
+        Zonal coefficients of every cluster of a tree, keyed by id(cluster).
+        '''
+        _, _, d, R, I, _ = group
+        coefs = {}
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            lo, hi, d0, c, children = node
+            coefs[id(node)] = zonal_coefficients(d0, d[lo:hi], R[lo:hi], I[lo:hi], order)
+            stack.extend(children)
+        return coefs
+
+    def traverse(self, tree, coefs, q, s, rho, d, R, I):
+        '''
+        Field of one group at axial positions s and radii rho (1D arrays).
+        Return B along the axis, B along rho, and the number of
+        loop (direct) plus cluster (expansion) evaluations.
+        '''
+        Bax = np.zeros_like(s)
+        Brho = np.zeros_like(s)
+        evals = 0
+
+        stack = [(tree, np.arange(len(s)))]
+        while stack:
+            node, idx = stack.pop()
+            lo, hi, d0, c, children = node
+            ds = s[idx] - d0
+            far = np.hypot(ds, rho[idx])*q >= c
+
+            if np.any(far):
+                f = idx[far]
+                bz, br = zonal_field(coefs[id(node)], ds[far], rho[f], self.mu0)
+                Bax[f] += bz
+                Brho[f] += br
+                evals += len(f)
+
+            near = idx[~far]
+            if len(near) == 0:
+                continue
+            if children:
+                stack.extend((child, near) for child in children)
+            else:
+                Bl = B_elliptic(rho[near], 0.0, s[near] - d[lo:hi, None],
+                                R[lo:hi, None], I[lo:hi, None], self.mu0)
+                Brho[near] += Bl[0].sum(axis=0)
+                Bax[near] += Bl[2].sum(axis=0)
+                evals += (hi - lo)*len(near)
+        # end while
+
+        return Bax, Brho, evals
+
+    def moments(self, node, tables, coefs):
+        '''
+        Moments of a general cluster about its center: from its loops at a leaf,
+        shifted up from its children's otherwise. The field coefficients of every
+        cluster go into coefs, keyed by id(cluster).
+        Return the moments.
+        '''
+        lo, hi, C, c, children, loops = node
+        if children:
+            mu = sum(shift_moments(self.moments(child, tables, coefs), child[2] - C, tables)
+                     for child in children)
+        else:
+            mu = disk_moments(loops, C, tables)
+        coefs[id(node)] = cartesian_coefficients(mu, tables, self.mu0)
+        return mu
+
+    def traverse_general(self, tree, coefs, q, P, tables):
+        '''
+        Field of the general tree at points P (3, m).
+        Return B (3, m), and the number of loop (direct) plus cluster (expansion) evaluations.
+        '''
+        B = np.zeros(P.shape)
+        evals = 0
+        # Fewer loops than this are cheaper to evaluate than an expansion.
+        cost = tables['K']/12
+
+        stack = [(tree, np.arange(P.shape[1]))]
+        while stack:
+            node, idx = stack.pop()
+            lo, hi, C, c, children, loops = node
+            if hi - lo > cost:
+                R = P[:, idx] - C[:, None]
+                far = np.sqrt(np.sum(R*R, axis=0))*q >= c
+                if np.any(far):
+                    f = idx[far]
+                    B[:, f] += cartesian_field(coefs[id(node)], R[:, far], tables)
+                    evals += len(f)
+                    idx = idx[~far]
+
+            if len(idx) == 0:
+                continue
+            if children:
+                stack.extend((child, idx) for child in children)
+            else:
+                B[:, idx] += loops.B_at(P[0, idx], P[1, idx], P[2, idx], hi - lo)
+                evals += (hi - lo)*len(idx)
+        # end while
+
+        return B, evals
+# end class
+
+
+if __name__ == '__main__':
+    import time
+    from math import pi
+    from P09111 import Solenoid
+
+    mu0 = 4e-7 * pi
+
+    # Test the expansion alone: one loop, far away
+    a = zonal_coefficients(0.0, np.array([0.003]), np.array([0.02]), np.array([3.0]), 30)
+    zs = np.array([0.2, 0.1, -0.15])
+    rs = np.array([0.0, 0.12, 0.05])
+    bz, br = zonal_field(a, zs, rs, mu0)
+    Be = B_elliptic(rs, 0*rs, zs - 0.003, 0.02, 3.0, mu0)
+    print('Expansion vs closed form: max rel. error = {:.3e}'.format(
+          np.max(np.hypot(bz - Be[2], br - Be[0])/np.hypot(Be[2], Be[0]))))
+
+    # Test a long solenoid on a large grid against the direct sum
+    s = Solenoid(0.004, 1.8, mu0, 400, 0.1)
+    Xs = np.linspace(-0.03, 0.03, 31)
+    Zs = np.linspace(-0.03, 0.13, 41)
+    t = time.time()
+    B1 = from_solenoid(s).compute_B(Xs, Xs, Zs)
+    t1 = time.time() - t
+    for tol in [1e-6, 1e-10]:
+        t = time.time()
+        B2 = Treecode(s).compute_B(Xs, Xs, Zs, tol=tol)
+        t2 = time.time() - t
+        print('Treecode (tol {:.0e}): {:.3f} s vs direct {:.3f} s, max rel. error = {:.3e}'.format(
+              tol, t2, t1, max(np.max(np.abs(b1 - b2)) for b1, b2 in zip(B1, B2))/np.max(np.abs(B1[2]))))
+
+    # Test a tilted array (every coil its own axis) against the direct sum
+    g = np.arange(40)*0.01
+    centers = np.stack(np.meshgrid(g, g, [0.0], indexing='ij'), axis=-1).reshape(-1, 3)
+    ca = CoilArray(centers, (0, 0.3, 1), 0.004, 1.0, mu0)
+    Xs = np.linspace(-0.2, 0.6, 40)
+    Zs = np.linspace(0.02, 0.3, 12)
+    t = time.time()
+    B1 = ca.compute_B(Xs, Xs, Zs)
+    t1 = time.time() - t
+    for tol in [1e-3, 1e-6]:
+        t = time.time()
+        B2 = Treecode(ca).compute_B(Xs, Xs, Zs, tol=tol)
+        t2 = time.time() - t
+        print('Tilted array, {} coils (tol {:.0e}): {:.3f} s vs direct {:.3f} s, max rel. error = {:.3e}'.format(
+              len(ca), tol, t2, t1, max(np.max(np.abs(b1 - b2)) for b1, b2 in zip(B1, B2))/np.max(np.abs(B1[2]))))
@@ -1,8 +1,15 @@
 import numpy as np
-from matplotlib import pyplot as plt
 from math import pi
 
 from P10 import dB, BVec
+try:
+    from P09111 import BVec_grid           # optional: the whole-grid kernel of the solutions
+except ImportError:
+    BVec_grid = None
+try:
+    from fieldvolume import LazyVolume     # optional: computes only the planes plotted
+except ImportError:
+    LazyVolume = None
 
 
 class CurrentLoop:
@@ -18,19 +25,35 @@ class CurrentLoop:
         self.I = I
         self.mu0 = mu0
 
-    def compute_B(self, X, Y, Z, N=1000):
+    def compute_B(self, X, Y, Z, N=1000, backend='scalar', mem_limit=256*2**20, dtype=float,
+                  cache=None):
         '''
         X: field range along x-axis
         Y: field range along y-axis
         Z: field range along z-axis
+        N: a number of subintervals of the theta integration
+        backend: 'scalar' calls BVec point by point;
+                 'numpy' evaluates the whole grid with P09111.BVec_grid
+                 (without P09111.py next to this file, it runs as 'scalar').
+        mem_limit: working-memory bound (bytes) for the 'numpy' backend
+        dtype: the precision of the field arrays ('numpy' also integrates in it)
+        cache: a fieldcache.FieldCache or UnitFieldCache to look the volume up in
+               (and store it to), or None.
         '''
+        if cache is not None:
+            return cache.compute_B(self, X, Y, Z, N=N, backend=backend, mem_limit=mem_limit,
+                                   dtype=dtype)
+
         # Since the loop is at self.z off the origin (0,0,0),
         # we need to offset this on Z.
         Zp = np.array(Z) - self.z
 
-        Bx = np.zeros((len(X), len(Y), len(Zp)))
-        By = np.zeros((len(X), len(Y), len(Zp)))
-        Bz = np.zeros((len(X), len(Y), len(Zp)))
+        if backend == 'numpy' and BVec_grid is not None:
+            return BVec_grid(X, Y, Zp, self.R, self.I, self.mu0, N, mem_limit, dtype=dtype)
+
+        Bx = np.zeros((len(X), len(Y), len(Zp)), dtype)
+        By = np.zeros((len(X), len(Y), len(Zp)), dtype)
+        Bz = np.zeros((len(X), len(Y), len(Zp)), dtype)
 
         # Compute each B at each point in volume X . Y . Zp
         for i, x in enumerate(X):
@@ -46,11 +69,20 @@ class CurrentLoop:
     # end def
 
 
-def unitvec(Fx, Fy, Fz):
+def unitvec(Fx, Fy, Fz, profile=None, dtype=None):
     '''
     F: field in shape (nx, ny, nz)
+    profile: a fieldprof.Profile to time this as stage 'unitvec', or None.
+    dtype: the precision to compute in (e.g., np.float32); None keeps F's own.
     '''
 
+    if profile is not None:
+        with profile.stage('unitvec'):
+            return unitvec(Fx, Fy, Fz, dtype=dtype)
+
+    if dtype is not None:
+        Fx, Fy, Fz = [np.asarray(F, dtype=dtype) for F in (Fx, Fy, Fz)]
+
     Fmag = np.sqrt(Fx**2 + Fy**2 + Fz**2)
     Ux = Fx/Fmag
     Uy = Fy/Fmag
@@ -60,21 +92,55 @@ def unitvec(Fx, Fy, Fz):
 
 
 
-def cl_viz(Xs, Ys, Zs, mu0, R, I):
+def field_planes(source, Xs, Ys, Zs, keys, **options):
+    '''
+    Planes of source's field on Xs . Ys . Zs.
+    keys: index tuples of the planes, e.g., (slice(None), [14, 19, 21]) for three y-planes.
+    options: compute_B options.
+    With fieldvolume.py next to this file, only those planes are computed (LazyVolume);
+    without it, the whole volume is, and the planes are taken from it.
+    Return a list of (Bx, By, Bz), one per key, and the number of grid points computed.
+    '''
+    if LazyVolume is None:
+        B = source.compute_B(Xs, Ys, Zs, **options)
+        return [tuple(b[key] for b in B) for key in keys], B[0].size
+
+    B = LazyVolume(source, Xs, Ys, Zs, **options)
+    return [B[key] for key in keys], B.computed
+
+
+def cl_viz(Xs, Ys, Zs, mu0, R, I, profile=None, dtype=float, fname=None, cache=None):
     '''
     Assuming Xs, Ys, Zs are uniformly distributed.
+    profile: a fieldprof.Profile; the field computation is timed as 'integration'.
+    dtype: the precision of the field (np.float32 is plenty for the plots).
+    fname: a file to save the figure to, instead of showing it (for batch jobs).
+    cache: passed on to CurrentLoop.compute_B, e.g., a fieldcache.FieldCache:
+           a repeat run then reads the planes instead of computing them.
     '''
 
+    # pyplot only here: importing this module (e.g., for CurrentLoop) stays fast.
+    from matplotlib import pyplot as plt
+
     # Instantiate a current loop
     print('Instantiate a current loop.')
     cl = CurrentLoop(0, R, I, mu0)
 
-    # Compute its magnetic field
+    # Its magnetic field: only the planes plotted below, if fieldvolume.py is there.
     print('Compute a magnetic field. It may take a moment...')
-    Bx, By, Bz = cl.compute_B(Xs, Ys, Zs, N=100)
+    zplanes = [13, 14, 26]
+    yplanes = [14, 19, 21]
+    keys = [(slice(None), slice(None), zplanes), (slice(None), yplanes)]
+    options = {'N': 100, 'backend': 'numpy', 'dtype': dtype, 'cache': cache}
+    if profile is None:
+        (Bxy, Bxz), _ = field_planes(cl, Xs, Ys, Zs, keys, **options)
+    else:
+        with profile.stage('integration'):
+            (Bxy, Bxz), computed = field_planes(cl, Xs, Ys, Zs, keys, **options)
+        profile.count('evals', options['N']*computed)
 
     # Compute unit vectors and magnitudes of the field
-    uBx, uBy, uBz, magB = unitvec(Bx, By, Bz)
+    uBx, uBy, uBz, magB = unitvec(*Bxy, profile=profile)
 
     ##################
     # Do the plots
@@ -105,9 +171,9 @@ def cl_viz(Xs, Ys, Zs, mu0, R, I):
     # Caution: imshow reverse y-axis
     # So, pay A LOT OF ATTENTION on the y-axis.
 
-    for n, i in enumerate([13, 14, 26]):
+    for n, i in enumerate(zplanes):
         plt.subplot(2,3,n+1)
-        plt.imshow(magB[:,::-1,i].T, cmap = 'Reds' , interpolation = 'nearest' ) # ```::-1```: Reverse order of the y-axis, so image comes out correctly.
+        plt.imshow(magB[:,::-1,n].T, cmap = 'Reds' , interpolation = 'nearest' ) # ```::-1```: Reverse order of the y-axis, so image comes out correctly.
         plt.title('z= {:.4f}'.format(Zs[i]))
         plt.xlabel('x')
         plt.ylabel('y')
@@ -118,16 +184,17 @@ def cl_viz(Xs, Ys, Zs, mu0, R, I):
         ax[0,n].set_yticks(list(range(len(Ys)))[::m])             # Tick every m points
         ax[0,n].set_yticklabels(["{:.2f}".format(y) for y in Ys[::-1][::m]])
 
-        plt.quiver(uBx[:,::-1,i].T, uBy[:,::-1,i].T)
+        plt.quiver(uBx[:,::-1,n].T, uBy[:,::-1,n].T)
 
         ax[0,n].set_aspect( 1 )
         loopcircle = plt.Circle(( xp , len(Ys) - 1 - yp ), (Rp2 - Rp1)/2, color='yellow', fill=False) # Y-axis starts from the top: ```len(Ys) - 1 - yp``` got it.
         ax[0,n].add_artist(loopcircle)
 
     print(Ys)
-    for n, i in enumerate([14, 19, 21]):
+    uBx, uBy, uBz, magB = unitvec(*Bxz, profile=profile)
+    for n, i in enumerate(yplanes):
         plt.subplot(2,3,n+4)
-        plt.imshow(magB[:,i,::-1].T, cmap = 'Reds' , interpolation = 'nearest' )
+        plt.imshow(magB[:,n,::-1].T, cmap = 'Reds' , interpolation = 'nearest' )
         plt.title('y= {:.4f}'.format(Ys[i]))
         plt.xlabel('x')
         plt.ylabel('z')
@@ -138,12 +205,16 @@ def cl_viz(Xs, Ys, Zs, mu0, R, I):
         ax[1,n].set_yticks(list(range(len(Zs)))[::m])             # Tick every m points
         ax[1,n].set_yticklabels(["{:.2f}".format(z) for z in Zs[::-1][::m]])
 
-        plt.quiver(uBx[:,i, ::-1].T, uBz[:,i, ::-1].T)
+        plt.quiver(uBx[:,n, ::-1].T, uBz[:,n, ::-1].T)
 
 
         plt.plot([Rp1, Rp2], len(Zs) - 1 - np.array([zp, zp]), 'y*-')
 
-    plt.show()
+    if fname is None:
+        plt.show()
+    else:
+        fig.savefig(fname)
+        plt.close(fig)
 
 # end def cl_viz
 
@@ -162,4 +233,4 @@ if __name__ == '__main__':
     Zs = np.arange(-0.04, 0.04, 0.003)
 
     # Run visualization
-    cl_viz(Xs, Ys, Zs, mu0, R, I)
\ No newline at end of file
+    cl_viz(Xs, Ys, Zs, mu0, R, I)
\ No newline at end of file
@@ -1,14 +1,26 @@
 import numpy as np
-from matplotlib import pyplot as plt
 from P11 import Solenoid
+try:
+    from fieldvolume import LazyVolume     # optional: computes only the planes plotted
+except ImportError:
+    LazyVolume = None
 
 from math import pi
 
-def unitvec(Fx, Fy, Fz):
+def unitvec(Fx, Fy, Fz, profile=None, dtype=None):
     '''
     F: field in shape (nx, ny, nz)
+    profile: a fieldprof.Profile to time this as stage 'unitvec', or None.
+    dtype: the precision to compute in (e.g., np.float32); None keeps F's own.
     '''
 
+    if profile is not None:
+        with profile.stage('unitvec'):
+            return unitvec(Fx, Fy, Fz, dtype=dtype)
+
+    if dtype is not None:
+        Fx, Fy, Fz = [np.asarray(F, dtype=dtype) for F in (Fx, Fy, Fz)]
+
     Fmag = np.sqrt(Fx**2 + Fy**2 + Fz**2)
     Ux = Fx/Fmag
     Uy = Fy/Fmag
@@ -17,21 +29,56 @@ def unitvec(Fx, Fy, Fz):
     return Ux, Uy, Uz, Fmag
 
 
-def sol_viz(Xs, Ys, Zs, R, CurrentI, mu0, Nturns, lengthL):
+def field_planes(source, Xs, Ys, Zs, keys, **options):
+    '''
+    Planes of source's field on Xs . Ys . Zs.
+    keys: index tuples of the planes, e.g., (slice(None), [14, 19, 21]) for three y-planes.
+    options: compute_B options.
+    With fieldvolume.py next to this file, only those planes are computed (LazyVolume);
+    without it, the whole volume is, and the planes are taken from it.
+    Return a list of (Bx, By, Bz), one per key, and the number of grid points computed.
+    '''
+    if LazyVolume is None:
+        B = source.compute_B(Xs, Ys, Zs, **options)
+        return [tuple(b[key] for b in B) for key in keys], B[0].size
+
+    B = LazyVolume(source, Xs, Ys, Zs, **options)
+    return [B[key] for key in keys], B.computed
+
+
+def sol_viz(Xs, Ys, Zs, R, CurrentI, mu0, Nturns, lengthL, profile=None, dtype=float,
+            cache=None, fname=None):
     '''
     Assuming Xs, Ys, Zs must be uniformly distributed.
     We use ```imshow```, so it arranges result pixel by pixel,
     so it has to be uniformly distributed (better with the same resoltion on all x, y, z.) 
+    profile: a fieldprof.Profile passed on to Solenoid.compute_B and unitvec, or None.
+    dtype: the precision of the field (np.float32 is plenty for the plots).
+    cache: passed on to Solenoid.compute_B, e.g., a fieldcache.UnitFieldCache:
+           calls with another CurrentI or mu0 then only rescale the field.
+    fname: a file to save the figure to, instead of showing it (for batch jobs).
     '''
 
+    # pyplot only here: importing this module (e.g., for unitvec) stays fast.
+    from matplotlib import pyplot as plt
+
     # Instantiate Solenoid
     print('Instantiate a solenoid.')
     s = Solenoid(R, CurrentI, mu0, Nturns, lengthL)
 
-    # Compute B
+    # Compute B: only the plane x = Xs[i] that is plotted (if fieldvolume.py is there)
     print('Compuate a magnetic field. It may take a while...')
-    Bx, By, Bz = s.compute_B(Xs, Ys, Zs, N=100)
-    uBx, uBy, uBz, magB = unitvec(Bx, By, Bz)    
+    # (Options beyond N only when used: a plain P11 solution takes none.)
+    options = {'N': 100}
+    if profile is not None:
+        options['profile'] = profile
+    if np.dtype(dtype) != np.float64:
+        options['dtype'] = dtype
+    if cache is not None:
+        options['cache'] = cache
+    i = 0
+    (Bx, By, Bz), = field_planes(s, Xs, Ys, Zs, [i], **options)[0]
+    uBx, uBy, uBz, magB = unitvec(Bx, By, Bz, profile)    
 
     #########################
     # Perform graphics
@@ -63,9 +110,8 @@ def sol_viz(Xs, Ys, Zs, R, CurrentI, mu0, Nturns, lengthL):
     # So, pay A LOT OF ATTENTION on the y-axis.
 
     # x = Xs[i]
-    i = 0
     plt.subplot(1,2,1)
-    im = plt.imshow(magB[i,:,::-1].T, cmap = 'Reds' , interpolation = 'nearest' )
+    im = plt.imshow(magB[:,::-1].T, cmap = 'Reds' , interpolation = 'nearest' )
     plt.title('Magnetic field (at x= {:.1f}): unit vector'.format(Xs[i]))
     plt.xlabel('y')
     plt.ylabel('z')
@@ -78,7 +124,7 @@ def sol_viz(Xs, Ys, Zs, R, CurrentI, mu0, Nturns, lengthL):
     ax[0].set_aspect( 1 )
 
     # plt.colorbar(im)
-    plt.quiver(uBy[i,:,::-1].T, uBz[i,:,::-1].T)
+    plt.quiver(uBy[:,::-1].T, uBz[:,::-1].T)
 
     markL = '.'
     markR = 'x'
@@ -90,7 +136,7 @@ def sol_viz(Xs, Ys, Zs, R, CurrentI, mu0, Nturns, lengthL):
     plt.plot(np.array([ Rp2 ]*s.N), len(Zs) - 1 - Zp, 'y'+markR)
 
     plt.subplot(1,2,2)
-    im = plt.imshow(magB[i,:,::-1].T, cmap = 'Reds' , interpolation = 'nearest' )
+    im = plt.imshow(magB[:,::-1].T, cmap = 'Reds' , interpolation = 'nearest' )
     plt.title('Magnetic field (at x= {:.1f}): vector with magnitude'.format(Xs[i]))
     plt.xlabel('y')
     plt.ylabel('z')
@@ -102,7 +148,7 @@ def sol_viz(Xs, Ys, Zs, R, CurrentI, mu0, Nturns, lengthL):
     ax[1].set_aspect( 1 )
 
     # plt.colorbar(im)
-    plt.quiver(By[i,:,::-1].T, Bz[i,:,::-1].T)
+    plt.quiver(By[:,::-1].T, Bz[:,::-1].T)
 
     markL = '.'
     markR = 'x'
@@ -113,7 +159,11 @@ def sol_viz(Xs, Ys, Zs, R, CurrentI, mu0, Nturns, lengthL):
     plt.plot(np.array([ Rp1 ]*s.N), len(Zs) - 1 - Zp, 'y'+markL)
     plt.plot(np.array([ Rp2 ]*s.N), len(Zs) - 1 - Zp, 'y'+markR)
 
-    plt.show()    
+    if fname is None:
+        plt.show()
+    else:
+        fig.savefig(fname)
+        plt.close(fig)
 
 
 # end def sol_viz